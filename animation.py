@@ -0,0 +1,148 @@
+# Rendering an animation: a sequence of frames in which the camera and the light sources move, saved as numbered PNG files.
+# The moves are given as keyframes. Each keyframe sets, at one frame, any of the camera's viewpoint, screen_x, screen_y and screen_z
+# (as in a scene file) and the position and strength of any of the lights. Between keyframes each value moves in a straight line,
+# and before the first (or after the last) keyframe that sets it, it keeps the value from that keyframe. Anything no keyframe sets
+# keeps its value from the scene.
+#
+# The scene is loaded once and kept for every frame, along with its textures, its packed store and its bounding volume hierarchy
+# (objects don't move, so none of them change). The primary hits don't depend on the lights either, so while the camera stays
+# still they are kept from one frame to the next, and a frame in which only the lights have moved just needs shading.
+#
+# A scene file can describe its animation in an "animation" section; see scenes/animation.json for an example.
+# Usage: python animation.py scenes/animation.json [--output-dir frames] [--rows-per-batch 10] [--max-cached-hits 1000000]
+import argparse
+import os
+import time
+
+import numpy as np
+
+from classes import Camera
+import jit_kernels
+import profiling
+import render
+import scene_file
+
+def read_animation(description): #the number of frames and the keyframes of the "animation" section of a scene description.
+    animation = description.get("animation",{})
+    keyframes = animation.get("keyframes",[])
+    frame_count = animation.get("frames",max([keyframe["frame"] for keyframe in keyframes],default=0)+1)
+    return frame_count,keyframes
+
+def keyframe_tracks(keyframes): #gather the keyframes into a track for each value they set, keyed by ("camera",name) or ("light",index,name). Each track is a list of (frame, value) pairs in frame order.
+    tracks = {}
+    for keyframe in sorted(keyframes,key=lambda keyframe: keyframe["frame"]):
+        for name,value in keyframe.get("camera",{}).items():
+            tracks.setdefault(("camera",name),[]).append((keyframe["frame"],np.array(value,dtype=float)))
+        for index,light in enumerate(keyframe.get("lights",[])):
+            for name,value in light.items():
+                tracks.setdefault(("light",index,name),[]).append((keyframe["frame"],np.array(value,dtype=float)))
+    return tracks
+
+def value_at(track,frame): #the value of a track at a frame, moving in a straight line between the keyframes on either side of it.
+    if(frame <= track[0][0]):
+        return track[0][1]
+    for (frame_0,value_0),(frame_1,value_1) in zip(track[:-1],track[1:]):
+        if(frame < frame_1):
+            return value_0+(value_1-value_0)*((frame-frame_0)/(frame_1-frame_0)) #when both keyframes have the same value, this is exactly that value, so a camera held still is seen as not moving.
+    return track[-1][1]
+
+def camera_at(camera,tracks,frame): #the camera at a frame. The resolution is the same in every frame.
+    def get(name,default):
+        track = tracks.get(("camera",name))
+        return default if track is None else value_at(track,frame)
+    viewpoint = get("viewpoint",np.asarray(camera.viewpoint,dtype=float))
+    screen_x = float(get("screen_x",camera.screen_x))
+    screen_y_min,screen_y_max = get("screen_y",np.array([camera.screen_y_min,camera.screen_y_max],dtype=float))
+    screen_z_min,screen_z_max = get("screen_z",np.array([camera.screen_z_min,camera.screen_z_max],dtype=float))
+    return Camera(viewpoint,screen_x,screen_y_min,screen_y_max,screen_z_min,screen_z_max,camera.res_y,camera.res_z)
+
+def lights_at(light_sources,light_strengths,tracks,frame): #the positions and strengths of the lights at a frame, starting from the scene's own.
+    light_sources = [np.asarray(light,dtype=float) for light in light_sources]
+    light_strengths = list(light_strengths)
+    for key,track in tracks.items():
+        if(key[0] != "light"):
+            continue
+        index,name = key[1],key[2]
+        if(index >= len(light_sources)):
+            raise ValueError("Keyframe for light "+str(index)+", but the scene only has "+str(len(light_sources))+" lights")
+        if(name == "position"):
+            light_sources[index] = value_at(track,frame)
+        elif(name == "strength"):
+            light_strengths[index] = float(value_at(track,frame))
+        else:
+            raise ValueError("Unknown light property in keyframe: "+str(name))
+    return light_sources,light_strengths
+
+def camera_view(camera): #everything about a camera that decides where its primary rays go.
+    return (tuple(np.asarray(camera.viewpoint,dtype=float)),camera.screen_x,camera.screen_y_min,camera.screen_y_max,camera.screen_z_min,camera.screen_z_max,camera.res_y,camera.res_z)
+
+def frame_path(output_dir,frame):
+    return os.path.join(output_dir,"frame_"+str(frame).zfill(4)+".png")
+
+def render_animation(scene,camera,keyframes,frame_count,output_dir,rows_per_batch = 10,max_cached_hits = 1000000): #render frames 0 to frame_count-1 and save them in output_dir as frame_0000.png, frame_0001.png, ... Returns the paths of the frames.
+    #The primary hits of the last camera position are kept for the next frame, up to max_cached_hits of them (each takes about 200 bytes);
+    #rows beyond that are traced again in every frame. Set it to 0 to trace every frame from scratch.
+    #The scene's lights are put back as they were once all the frames are done.
+    os.makedirs(output_dir,exist_ok=True)
+    scene.pack() #once for the whole animation, since the objects don't move.
+    tracks = keyframe_tracks(keyframes)
+    scene_lights = (scene.light_sources,scene.light_strengths)
+    cached_view = None
+    cached_hits = {} #the primary hits of each batch of rows, by its first row, as returned by render.find_primary_hits.
+    paths = []
+    try:
+        for frame in range(0,frame_count):
+            frame_camera = camera_at(camera,tracks,frame)
+            scene.light_sources,scene.light_strengths = lights_at(*scene_lights,tracks,frame)
+            if(camera_view(frame_camera) != cached_view): #the camera has moved, so every primary ray goes somewhere new.
+                cached_view = camera_view(frame_camera)
+                cached_hits = {}
+            cached_count = sum(len(hit) for hit,hits in cached_hits.values())
+            reused = 0
+
+            pixels = np.full((camera.res_y,camera.res_z,3),127,dtype=np.uint8)
+            for i_start in range(0,camera.res_y,rows_per_batch):
+                i_stop = min(i_start+rows_per_batch,camera.res_y)
+                if(i_start in cached_hits):
+                    hit,hits = cached_hits[i_start]
+                    reused += i_stop-i_start
+                else:
+                    i_indices,j_indices = np.meshgrid(np.arange(i_start,i_stop),np.arange(0,camera.res_z),indexing="ij")
+                    sources,directions = frame_camera.get_rays(i_indices.ravel(),j_indices.ravel())
+                    profiling.count_rays("primary",len(sources))
+                    with profiling.stage("shading"):
+                        hit,hits = render.find_primary_hits(scene,sources,directions,frame_camera.get_pixel_size())
+                    if(cached_count+len(hit) <= max_cached_hits):
+                        cached_hits[i_start] = (hit,hits)
+                        cached_count += len(hit)
+                colors = np.full(((i_stop-i_start)*camera.res_z,3),127,dtype=np.uint8) #pixels that don't hit anything stay grey.
+                if(len(hit) > 0):
+                    with profiling.stage("shading"):
+                        colors[hit] = render.shade_hits(scene,hits)
+                pixels[i_start:i_stop] = colors.reshape(i_stop-i_start,camera.res_z,3)
+
+            path = frame_path(output_dir,frame)
+            render.save_image(pixels,path)
+            paths.append(path)
+            print("Rendered frame "+str(frame+1)+" of "+str(frame_count)+" to "+path+" (reused the primary hits of "+str(reused)+" of "+str(camera.res_y)+" rows)")
+    finally:
+        scene.light_sources,scene.light_strengths = scene_lights
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the animation described in a scene file as numbered PNG frames.")
+    parser.add_argument("scene",help="a scene file with an \"animation\" section")
+    parser.add_argument("--output-dir",default="frames",help="where to save the frames")
+    parser.add_argument("--rows-per-batch",type=int,default=10,help="how many rows of pixels to trace at once")
+    parser.add_argument("--max-cached-hits",type=int,default=1000000,help="the most primary hits to keep between frames while the camera is still (0 to trace every frame from scratch)")
+    arguments = parser.parse_args()
+    start = time.time()
+    if(jit_kernels.enabled):
+        jit_kernels.warm_up()
+    scene,camera = scene_file.load_scene(arguments.scene)
+    frame_count,keyframes = read_animation(scene_file.read_scene_file(arguments.scene))
+    render_animation(scene,camera,keyframes,frame_count,arguments.output_dir,arguments.rows_per_batch,arguments.max_cached_hits)
+    print("Took "+str(time.time()-start)+" seconds")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Adaptive anti-aliasing: extra rays are only traced through the pixels that need them.
+# The screen is first rendered with one ray through the centre of each pixel, as usual. A pixel is on an edge if one of its neighbours
+# shows a different object, or a colour that differs from its own by more than a threshold (e.g. along a shadow or a texture seam).
+# Only the edge pixels get extra rays, each moved by a random amount within its own cell of a grid over the pixel ("jittered"), and
+# their colour becomes the average of all their rays. Since edges are usually a small part of the image, this costs far less than
+# tracing extra rays through every pixel.
+import numpy as np
+
+import render
+
+def render_first_pass(scene,camera,batch_size = 20000): #render one ray through the centre of each pixel. Returns the (res_y,res_z,3) pixel array and the (res_y,res_z) indices of the object seen in each pixel (-1 for none).
+    pixels = np.empty((camera.res_y,camera.res_z,3),dtype=np.uint8)
+    hit_indices = np.empty((camera.res_y,camera.res_z),dtype=int)
+    rows_per_batch = max(1,batch_size//camera.res_z)
+    for i_start in range(0,camera.res_y,rows_per_batch):
+        i_stop = min(i_start+rows_per_batch,camera.res_y)
+        i_indices,j_indices = np.meshgrid(np.arange(i_start,i_stop),np.arange(0,camera.res_z),indexing="ij")
+        sources,directions = camera.get_rays(i_indices.ravel(),j_indices.ravel())
+        colors,indices = render.cast_ray_batch(scene,sources,directions,camera.get_pixel_size(),return_indices=True)
+        pixels[i_start:i_stop] = colors.reshape(i_stop-i_start,camera.res_z,3)
+        hit_indices[i_start:i_stop] = indices.reshape(i_stop-i_start,camera.res_z)
+    return pixels,hit_indices
+
+def edge_contrast(pixels,hit_indices): #how much each pixel differs from its most different neighbour (above, below, left or right): the biggest difference in any colour channel, or 256 if a neighbour shows a different object.
+    colors = pixels.astype(int)
+    contrast = np.zeros(hit_indices.shape,dtype=int)
+    for axis in (0,1):
+        before = [slice(None),slice(None)] #the pixels with a neighbour after them along this axis...
+        after = [slice(None),slice(None)] #...and those neighbours.
+        before[axis] = slice(0,-1)
+        after[axis] = slice(1,None)
+        before,after = tuple(before),tuple(after)
+        difference = np.abs(colors[before]-colors[after]).max(axis=2)
+        difference[hit_indices[before] != hit_indices[after]] = 256
+        contrast[before] = np.maximum(contrast[before],difference)
+        contrast[after] = np.maximum(contrast[after],difference)
+    return contrast
+
+def jittered_offsets(count,samples,rng): #offsets (in pixels, from the centre of the pixel) for "samples" rays through each of "count" pixels. The pixel is split into a grid of cells, and each ray goes through a random point in a different cell.
+    #When samples isn't a square number, some cells get no ray. Which ones is picked at random for each pixel, so that the missing
+    #cells aren't always in the same corner (which would shift every anti-aliased pixel slightly).
+    grid = int(np.ceil(np.sqrt(samples)))
+    cells = rng.permuted(np.broadcast_to(np.arange(grid*grid),(count,grid*grid)),axis=1)[:,:samples]
+    cell_y = cells%grid
+    cell_z = cells//grid
+    offsets_y = (cell_y+rng.random((count,samples)))/grid-0.5
+    offsets_z = (cell_z+rng.random((count,samples)))/grid-0.5
+    return np.stack((offsets_y,offsets_z),axis=2).reshape(-1,2)
+
+def render_adaptive(scene,camera,samples = 8,threshold = 16,sample_budget = None,batch_size = 20000,seed = 0): #render the screen with adaptive anti-aliasing. Returns the (res_y,res_z,3) pixel array.
+    #Edge pixels get "samples" extra rays each. Pixels whose neighbours differ by more than "threshold" (in any colour channel, out of 255)
+    #count as edges. sample_budget, if given, is the most extra rays to trace; when there are more edge pixels than it allows, the ones
+    #with the most contrast get the extra rays. seed makes the jittering the same each time.
+    scene.pack()
+    pixels,hit_indices = render_first_pass(scene,camera,batch_size)
+    contrast = edge_contrast(pixels,hit_indices)
+    edges = np.flatnonzero(contrast>threshold)
+    if(sample_budget is not None and len(edges)*samples > sample_budget):
+        most_contrast = np.argsort(-contrast.ravel()[edges],kind="stable")
+        edges = np.sort(edges[most_contrast[:sample_budget//samples]])
+    print("Anti-aliasing "+str(len(edges))+" edge pixels of "+str(camera.res_y*camera.res_z)+" with "+str(len(edges)*samples)+" extra rays")
+    if(len(edges) == 0 or samples == 0):
+        return pixels
+
+    rng = np.random.default_rng(seed)
+    totals = pixels.reshape(-1,3)[edges].astype(float) #the first ray through each pixel counts towards its average too.
+    pixels_per_batch = max(1,batch_size//samples)
+    for start in range(0,len(edges),pixels_per_batch):
+        batch = edges[start:start+pixels_per_batch]
+        i_indices,j_indices = np.divmod(np.repeat(batch,samples),camera.res_z)
+        sources,directions = camera.get_rays(i_indices,j_indices,jittered_offsets(len(batch),samples,rng))
+        colors = render.cast_ray_batch(scene,sources,directions,camera.get_pixel_size())
+        totals[start:start+len(batch)] += colors.reshape(len(batch),samples,3).sum(axis=1)
+    pixels.reshape(-1,3)[edges] = np.round(totals/(samples+1)).astype(np.uint8)
+    return pixels
@@ -0,0 +1,117 @@
+# Benchmarks for the vectorised renderer, to catch changes that make it slower and to see where the time goes.
+# Renders a set of reference scenes at several resolutions and saves, for each render, how long it took, how many rays per second
+# were traced, and the counts from profiling.py (rays of each kind, intersection tests per type of shape, and time spent per stage).
+#
+# Usage: python benchmark.py [--scenes bundled mirror_slices] [--resolutions 100 200 400] [--workers 1] [--repeats 1] [--no-jit] [--output benchmark.json]
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+
+import jit_kernels
+import profiling
+import render
+import scene_file
+
+scenes_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"scenes")
+
+def bundled_scene(): #the scene defined in raytracing.py (and scenes/default.json).
+    return scene_file.read_scene_file(os.path.join(scenes_dir,"default.json"))
+
+def many_spheres_scene(): #the bundled room with a 16 x 16 grid of small spheres on the floor.
+    description = bundled_scene()
+    description["materials"]["matte"] = {"color":[220,120,40],"diffusivity":0.8,"specularity":0.2,"shininess":20}
+    spheres = []
+    for y in np.linspace(-4,4,16):
+        for x in np.linspace(-3,4.5,16):
+            material = "ball_material" if (len(spheres)%5 == 0) else "matte" #every fifth sphere is a mirror.
+            spheres.append({"type":"sphere","centre":[float(x),float(y),0.2],"radius":0.2,"material":material})
+    description["objects"] = spheres+[object for object in description["objects"] if object["type"] == "plane"]
+    return description
+
+def many_spheres_bvh_scene(): #the same spheres, put in a bounding volume hierarchy. Compare with many_spheres to see whether the hierarchy is worth it: it is without Numba, but the compiled kernels test every sphere quicker than the hierarchy (which is walked with NumPy) can skip them.
+    description = many_spheres_scene()
+    description["bvh"] = True
+    return description
+
+def mirror_slices_scene(): #the bundled room with two concave mirrors facing each other, so that rays bounce back and forth many times.
+    description = bundled_scene()
+    description["reflection_limit"] = 16
+    mirror = {"color":[200,200,220],"diffusivity":0.1,"specularity":0.3,"shininess":40,"reflectivity":0.9}
+    description["objects"] = [
+        {"type":"sphere","centre":[1.5,0,1],"radius":0.7,"material":"ball_material"},
+        {"type":"sphere_slice","edge_centre":[4.5,0,1.5],"radius":4,"pole_dir":[-1,0,0],"max_edge_dist":1.5,"material":mirror},
+        {"type":"sphere_slice","edge_centre":[-1.5,0,1.5],"radius":4,"pole_dir":[1,0,0],"max_edge_dist":1.5,"material":mirror},
+    ]+[object for object in description["objects"] if object["type"] == "plane"]
+    return description
+
+def textured_plane_scene(): #a textured floor stretching away to the horizon, with mipmapped texture filtering.
+    description = bundled_scene()
+    description["texture_filter"] = "mipmap"
+    description["camera"].update({"viewpoint":[-24,0,3],"screen_y":[-1,1],"screen_z":[2,3.5]})
+    description["objects"] = [{"type":"plane","point":[0,0,0],"normal":[0,0,1],"material":"ground_material","second_point":[1,0,0],"texture":"../textures/grass_seamless.jpg","tex_size":20}]
+    return description
+
+reference_scenes = {
+    "bundled":bundled_scene,
+    "many_spheres":many_spheres_scene,
+    "many_spheres_bvh":many_spheres_bvh_scene,
+    "mirror_slices":mirror_slices_scene,
+    "textured_plane":textured_plane_scene,
+}
+
+def run_benchmark(name,resolution,workers = 1,repeats = 1): #render a reference scene at resolution x resolution pixels, "repeats" times. Returns the results of the quickest run.
+    description = copy.deepcopy(reference_scenes[name]())
+    description["camera"]["resolution"] = [resolution,resolution]
+    best = None
+    for repeat in range(0,repeats):
+        scene,camera = scene_file.build_scene(description,scenes_dir) #built afresh each time, so every run starts with the same (empty) occluder cache.
+        profiling.reset()
+        with contextlib.redirect_stdout(io.StringIO()): #hide the renderer's progress messages.
+            start = time.perf_counter()
+            if(workers == 1):
+                pixels = render.render(scene,camera)
+            else:
+                pixels = render.render_parallel(scene,camera,workers)
+            render_seconds = time.perf_counter()-start
+        with tempfile.TemporaryDirectory() as output_dir:
+            render.save_image(pixels,os.path.join(output_dir,"output.png"))
+        result = {"scene":name,"resolution":[resolution,resolution],"workers":workers,"jit":jit_kernels.enabled,"render_seconds":render_seconds}
+        result.update(profiling.report())
+        result["rays_per_second"] = result["total_rays"]/render_seconds
+        if(best is None or render_seconds < best["render_seconds"]):
+            best = result
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorised renderer on a set of reference scenes.")
+    parser.add_argument("--scenes",nargs="+",choices=sorted(reference_scenes),default=list(reference_scenes))
+    parser.add_argument("--resolutions",nargs="+",type=int,default=[100,200,400])
+    parser.add_argument("--workers",type=int,default=1,help="how many processes to render with")
+    parser.add_argument("--repeats",type=int,default=1,help="render each scene this many times, and keep the quickest")
+    parser.add_argument("--no-jit",action="store_true",help="use the NumPy kernels even if Numba is installed")
+    parser.add_argument("--output",default="benchmark.json",help="where to save the results (as JSON)")
+    arguments = parser.parse_args()
+    jit_kernels.enabled = jit_kernels.available and not arguments.no_jit
+    if(jit_kernels.enabled):
+        jit_kernels.warm_up() #so that compiling the kernels isn't counted in the first render.
+
+    results = []
+    for name in arguments.scenes:
+        for resolution in arguments.resolutions:
+            result = run_benchmark(name,resolution,arguments.workers,arguments.repeats)
+            results.append(result)
+            print(name+" at "+str(resolution)+"x"+str(resolution)+": "+format(result["render_seconds"],".3f")+" s, "+format(result["rays_per_second"],",.0f")+" rays/s")
+    with open(arguments.output,"w") as output_file:
+        json.dump({"machine":platform.platform(),"python":platform.python_version(),"numpy":np.__version__,"results":results},output_file,indent=2)
+    print("Saved the results to "+arguments.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# A bounding volume hierarchy (BVH) to speed up intersection tests in scenes with lots of objects.
+# Objects with a bounding box (spheres and sphere slices) are sorted into a binary tree of boxes, so a batch of rays only has to be
+# tested against the objects in the boxes it passes through. Objects without a bounding box (planes) are kept in a separate list and
+# are tested against every ray.
+import numpy as np
+
+class BVHNode: #a box in the hierarchy. Leaf nodes hold the indices of their objects; other nodes hold two child nodes.
+    def __init__(self,box_min,box_max,object_indices = None,left = None,right = None):
+        self.box_min = box_min #the corners of the box holding everything in this node.
+        self.box_max = box_max
+        self.object_indices = object_indices
+        self.left = left
+        self.right = right
+
+    def is_leaf(self):
+        return self.object_indices is not None
+
+    def slab_test(self,sources,inverse_directions): #returns the t-values at which each ray enters and leaves the box. The ray misses the box if it leaves before it enters.
+        with np.errstate(invalid="ignore"): #a ray parallel to a face that starts on it gives 0*inf = NaN here, which fmin/fmax ignore.
+            t_lower = (self.box_min-sources)*inverse_directions
+            t_upper = (self.box_max-sources)*inverse_directions
+        t_enter = np.fmax.reduce(np.fmin(t_lower,t_upper),axis=1)
+        t_exit = np.fmin.reduce(np.fmax(t_lower,t_upper),axis=1)
+        return t_enter,t_exit
+
+class BVH: #the boxes are worked out from the objects when the BVH is made, and aren't updated if the objects change afterwards.
+    def __init__(self,objects,leaf_size = 4): #leaf_size is the most objects that will be put in one leaf box.
+        self.objects = objects
+        self.leaf_size = leaf_size
+        self.unbounded_indices = [] #the objects (planes) that are always tested.
+        bounded_indices = []
+        bounds_min = []
+        bounds_max = []
+        for k,object in enumerate(objects):
+            bounds = object.get_bounds()
+            if(bounds is None):
+                self.unbounded_indices.append(k)
+            else:
+                bounded_indices.append(k)
+                bounds_min.append(bounds[0])
+                bounds_max.append(bounds[1])
+        self.root = None
+        if(len(bounded_indices) > 0):
+            bounds_min = np.array(bounds_min,dtype=float)
+            bounds_max = np.array(bounds_max,dtype=float)
+            padding = 1e-9*(1+np.abs(bounds_min)+np.abs(bounds_max)) #pad the boxes a little so that rounding errors don't make rays miss them.
+            self.root = self.build(np.array(bounded_indices),bounds_min-padding,bounds_max+padding)
+
+    def build(self,indices,bounds_min,bounds_max): #recursively split the objects in half along the longest axis of their centres, until each leaf holds at most leaf_size objects.
+        box_min = bounds_min.min(axis=0)
+        box_max = bounds_max.max(axis=0)
+        if(len(indices) <= self.leaf_size):
+            return BVHNode(box_min,box_max,object_indices=[int(k) for k in indices])
+        centres = (bounds_min+bounds_max)/2
+        axis = np.argmax(centres.max(axis=0)-centres.min(axis=0))
+        order = np.argsort(centres[:,axis],kind="stable")
+        half = len(indices)//2
+        left,right = order[:half],order[half:]
+        return BVHNode(box_min,box_max,left=self.build(indices[left],bounds_min[left],bounds_max[left]),right=self.build(indices[right],bounds_min[right],bounds_max[right]))
+
+    def closest_hit(self,sources,directions,max_t = 10000): #find the closest intersection of each ray, following the same rules as nearest_hits in render.py (which tests every object). Returns the t-values, the object indices and whether each ray hit anything at its t_0.
+        min_t = np.full(len(sources),max_t,dtype=float)
+        min_index = np.zeros(len(sources),dtype=int)
+        front_hit = np.zeros(len(sources),dtype=bool)
+
+        def test_object(k,rays): #intersect the rays with object k and keep any closer hits. Ties go to the object that comes first in the list.
+            t_0,t_1,hit_0,hit_1 = self.objects[k].intersects_batch(sources[rays],directions[rays])
+            trace_t = np.where(t_0>0,t_0,np.where(t_1>0,t_1,max_t))
+            closer = (trace_t<min_t[rays]) | ((trace_t==min_t[rays]) & (k<min_index[rays]) & (trace_t<max_t))
+            min_t[rays[closer]] = trace_t[closer]
+            min_index[rays[closer]] = k
+            front_hit[rays[t_0>0]] = True
+
+        all_rays = np.arange(len(sources))
+        for k in self.unbounded_indices: #test the planes first; they usually give a close hit that lets lots of boxes be skipped.
+            test_object(k,all_rays)
+        if(self.root is None):
+            return min_t,min_index,front_hit
+
+        with np.errstate(divide="ignore"):
+            inverse_directions = 1/directions
+        stack = [(self.root,all_rays)]
+        while(len(stack) > 0):
+            node,rays = stack.pop()
+            t_enter,t_exit = node.slab_test(sources[rays],inverse_directions[rays])
+            #skip the box if the ray misses it, if the box is behind the ray, or if the ray already hit something closer.
+            #Rays without a hit at t_0 yet keep going, since add_reflection only counts those as hits.
+            keep = (t_enter<=t_exit) & (t_exit>=0) & ((t_enter<=min_t[rays]) | ~front_hit[rays])
+            rays = rays[keep]
+            if(len(rays) == 0):
+                continue
+            if(node.is_leaf()):
+                for k in node.object_indices:
+                    test_object(k,rays)
+            else:
+                stack.append((node.right,rays))
+                stack.append((node.left,rays))
+        return min_t,min_index,front_hit
+
+    def occluders(self,sources,directions,t_min = 0.0001,t_max = 1): #find an object that each ray hits with t_min < t < t_max, giving its index (or -1 if there isn't one). Rays stop being tested as soon as something is found in the way.
+        occluders = np.full(len(sources),-1)
+
+        def test_object(k,rays):
+            occluders[rays[self.objects[k].occludes_batch(sources[rays],directions[rays],t_min,t_max)]] = k
+
+        for k in self.unbounded_indices:
+            test_object(k,np.flatnonzero(occluders<0))
+        if(self.root is None):
+            return occluders
+
+        with np.errstate(divide="ignore"):
+            inverse_directions = 1/directions
+        stack = [(self.root,np.flatnonzero(occluders<0))]
+        while(len(stack) > 0):
+            node,rays = stack.pop()
+            rays = rays[occluders[rays]<0] #rays that were blocked since this node was put on the stack don't need testing any more.
+            if(len(rays) == 0):
+                continue
+            t_enter,t_exit = node.slab_test(sources[rays],inverse_directions[rays])
+            rays = rays[(t_enter<=t_exit) & (t_exit>t_min) & (t_enter<t_max)]
+            if(len(rays) == 0):
+                continue
+            if(node.is_leaf()):
+                for k in node.object_indices:
+                    test_object(k,rays[occluders[rays]<0])
+            else:
+                stack.append((node.right,rays))
+                stack.append((node.left,rays))
+        return occluders
@@ -0,0 +1,210 @@
+# Checks that the vectorised renderer still gives exactly the same images as the per-pixel cast_ray loop in raytracing.py.
+# Each check renders two small scenes (the bundled scene from scenes/default.json, and a scene with two concave SphereSlice mirrors
+# facing each other) a few pixels across, in two ways that should agree, and counts the pixels that differ. Run it after changing
+# anything in the renderer. The checks compare:
+#   vectorised: render.render against the cast_ray loop.
+#   bvh: renders with and without a bounding volume hierarchy, before and after moving an object.
+#   store: the packed scene store's closest hits and shadow tests against testing each object in turn.
+#   parallel: render_parallel, with tiles spread over worker processes, against render.render.
+#   png_output: PNG files from save_image and render_streaming against PIL.
+#   jit: the compiled kernels in jit_kernels.py against NumPy (skipped if Numba isn't installed).
+#   progressive: render_progressive against render.render.
+#   tile_cache: render_incremental against render.render, after changing a material and after moving the lights.
+#   animation: the frames of animation.render_animation against render.render of each frame's camera and lights.
+#
+# Usage: python check_parity.py [--resolution 24]   (exits with status 1 if any pixel differs)
+import argparse
+import contextlib
+import copy
+import io
+import os
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+import animation
+import antialiasing
+import image_output
+import jit_kernels
+import progressive
+import raytracing
+import render
+import scene_file
+
+scenes_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"scenes")
+
+def bundled_scene():
+    return scene_file.read_scene_file(os.path.join(scenes_dir,"default.json"))
+
+def mirror_scene(): #a ball between two concave mirrors, so that rays bounce between them up to the reflection limit.
+    description = bundled_scene()
+    description["reflection_limit"] = 8
+    mirror = {"color":[200,200,220],"diffusivity":0.1,"specularity":0.3,"shininess":40,"reflectivity":0.9}
+    description["objects"] = [
+        {"type":"sphere","centre":[1.5,0,1],"radius":0.7,"material":{"color":[220,80,20],"diffusivity":0.7,"specularity":0.0,"shininess":500}},
+        {"type":"sphere_slice","edge_centre":[4.5,0,1.5],"radius":4,"pole_dir":[-1,0,0],"max_edge_dist":1.5,"material":mirror},
+        {"type":"sphere_slice","edge_centre":[-1.5,0,1.5],"radius":4,"pole_dir":[1,0,0],"max_edge_dist":1.5,"material":mirror},
+    ]+[object for object in description["objects"] if object["type"] == "plane"]
+    return description
+
+test_scenes = {"bundled":bundled_scene,"mirrors":mirror_scene}
+
+def build(description,resolution): #a fresh Scene and Camera for a scene description, at resolution x resolution pixels.
+    description = copy.deepcopy(description)
+    description["camera"]["resolution"] = [resolution,resolution]
+    return scene_file.build_scene(description,scenes_dir)
+
+def differing_pixels(pixels_1,pixels_2):
+    return int((pixels_1 != pixels_2).any(axis=2).sum())
+
+def render_per_pixel(scene,camera): #render with the cast_ray loop in raytracing.py.
+    raytracing.use_scene(scene,camera)
+    for i in range(0,camera.res_y):
+        for j in range(0,camera.res_z):
+            raytracing.cast_ray(camera.screen_x,camera.screen_y_points[i],camera.screen_z_points[j],i,j)
+    return raytracing.pixels.copy()
+
+def check_vectorised(description,resolution): #render.render against the cast_ray loop.
+    return differing_pixels(render_per_pixel(*build(description,resolution)),render.render(*build(description,resolution)))
+
+def check_bvh(description,resolution): #the same render with and without a bounding volume hierarchy, before and after moving the first object (a sphere) in the scene.
+    scene,camera = build(description,resolution)
+    scene.build_bvh(leaf_size=1) #one object per leaf, so that even these small scenes get a few levels of boxes.
+    differences = differing_pixels(render.render(*build(description,resolution)),render.render(scene,camera))
+    move = np.array([-2.0,2.5,0.5])
+    scene.objects[0].centre = scene.objects[0].centre+move #the next render has to build the hierarchy again.
+    plain_scene,camera = build(description,resolution)
+    plain_scene.objects[0].centre = plain_scene.objects[0].centre+move
+    return differences+differing_pixels(render.render(plain_scene,camera),render.render(scene,camera))
+
+def closest_hit_per_object(objects,sources,directions): #the closest hit of each ray, testing the objects one at a time in list order (so ties go to the first object).
+    min_t = np.full(len(sources),render.max_t,dtype=float)
+    min_index = np.zeros(len(sources),dtype=int)
+    front_hit = np.zeros(len(sources),dtype=bool)
+    for k,object in enumerate(objects):
+        t_0,t_1,hit_0,hit_1 = object.intersects_batch(sources,directions)
+        trace_t = np.where(t_0>0,t_0,np.where(t_1>0,t_1,render.max_t))
+        front_hit |= t_0>0
+        closer = trace_t<min_t
+        min_t[closer] = trace_t[closer]
+        min_index[closer] = k
+    return min_t,min_index,front_hit
+
+def check_store(description,resolution): #the packed scene store against testing the objects one at a time: the closest hit of each pixel's primary ray, and whether the shadow rays from there to each light are blocked.
+    scene,camera = build(description,resolution)
+    i_indices,j_indices = np.meshgrid(np.arange(0,camera.res_y),np.arange(0,camera.res_z),indexing="ij")
+    sources,directions = camera.get_rays(i_indices.ravel(),j_indices.ravel())
+    jit_enabled = jit_kernels.enabled
+    jit_kernels.enabled = False #check the NumPy code in scene_store.py. check_jit compares the compiled kernels with it.
+    try:
+        store_hits = scene.store.closest_hit(sources,directions,render.max_t)
+        object_hits = closest_hit_per_object(scene.objects,sources,directions)
+        different = np.zeros(len(sources),dtype=bool)
+        for store_values,object_values in zip(store_hits,object_hits):
+            different |= store_values != object_values
+        points = sources+directions*store_hits[0][:,None]
+        for light_source in scene.light_sources:
+            shadow_vects = light_source-points
+            blocked = np.zeros(len(points),dtype=bool)
+            for object in scene.objects:
+                blocked |= object.occludes_batch(points,shadow_vects)
+            different |= (scene.store.occluders(points,shadow_vects)>=0) != blocked
+    finally:
+        jit_kernels.enabled = jit_enabled
+    return int(different.sum())
+
+def check_parallel(description,resolution): #render_parallel, with two worker processes, against render.render.
+    scene,camera = build(description,resolution)
+    return differing_pixels(render.render(scene,camera),render.render_parallel(scene,camera,workers=2,tile_size=10)) #10 doesn't divide the resolution, so there are part-sized tiles too.
+
+def check_png_output(description,resolution): #PNG files written by image_output.PNGWriter (through save_image, and rendered strip by strip with render_streaming) against the same image saved by PIL.
+    scene,camera = build(description,resolution)
+    pixels = render.render(scene,camera)
+    with tempfile.TemporaryDirectory() as output_dir:
+        paths = [os.path.join(output_dir,name) for name in ("pil.bmp","saved.png","streamed.png")]
+        render.save_image(pixels,paths[0]) #formats other than PNG are saved by PIL.
+        render.save_image(pixels,paths[1],rows_per_strip=5) #small strips, so that the image is written in several parts.
+        render.render_streaming(scene,camera,paths[2],rows_per_strip=7)
+        expected,saved,streamed = [np.asarray(Image.open(path).convert("RGB")) for path in paths]
+    return differing_pixels(expected,saved)+differing_pixels(expected,streamed)
+
+def check_jit(description,resolution): #the same render with the compiled kernels in jit_kernels.py and with NumPy. Returns None (skipped) if Numba isn't installed.
+    if(not jit_kernels.available):
+        return None
+    jit_enabled = jit_kernels.enabled
+    try:
+        jit_kernels.enabled = False
+        numpy_pixels = render.render(*build(description,resolution))
+        jit_kernels.enabled = True
+        jit_pixels = render.render(*build(description,resolution))
+    finally:
+        jit_kernels.enabled = jit_enabled
+    return differing_pixels(numpy_pixels,jit_pixels)
+
+def check_progressive(description,resolution): #render_progressive against render.render.
+    scene,camera = build(description,resolution)
+    return differing_pixels(render.render(scene,camera),progressive.render_progressive(scene,camera,start_step=4))
+
+def check_tile_cache(description,resolution): #render_incremental against render.render: first with an empty tile cache, then after changing the material of the object seen in the most pixels, and then after moving the lights. Any tile reused when it shouldn't have been shows up as differing pixels.
+    scene,camera = build(description,resolution)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        def compare():
+            return differing_pixels(render.render(scene,camera),progressive.render_incremental(scene,camera,cache_dir,tile_size=10)) #10 doesn't divide the resolution, so there are part-sized tiles too.
+        differences = compare()
+        pixels,hit_indices = antialiasing.render_first_pass(scene,camera)
+        object = scene.objects[np.bincount(hit_indices[hit_indices>=0]).argmax()] #the object seen in the most pixels.
+        object.material = copy.copy(object.material) #the material may be shared with other objects, which should keep the old one.
+        object.material.color = [250,220,40]
+        object.material.diffusivity = 0.9
+        differences += compare()
+        scene.light_sources = [light_source+np.array([0,-3,0]) for light_source in scene.light_sources]
+        differences += compare()
+    return differences
+
+def check_animation(description,resolution): #the frames saved by animation.render_animation against render.render of the same camera and lights. The lights move in frames 0 to 2 (so the primary hits are reused) and the camera in frames 3 and 4.
+    view = description["camera"]
+    viewpoint = np.array(view["viewpoint"],dtype=float)
+    light_source = np.array(description["lights"][0]["position"],dtype=float)
+    still_camera = {"viewpoint":viewpoint.tolist(),"screen_x":view["screen_x"]}
+    keyframes = [
+        {"frame":0,"lights":[{"position":light_source.tolist()}],"camera":still_camera},
+        {"frame":2,"lights":[{"position":(light_source+[0,-6,0]).tolist()}],"camera":still_camera},
+        {"frame":4,"camera":{"viewpoint":(viewpoint+[2,0,-1]).tolist(),"screen_x":view["screen_x"]+2}},
+    ]
+    tracks = animation.keyframe_tracks(keyframes)
+    differences = 0
+    with tempfile.TemporaryDirectory() as output_dir:
+        paths = animation.render_animation(*build(description,resolution),keyframes,5,output_dir)
+        for frame,path in enumerate(paths):
+            scene,camera = build(description,resolution)
+            scene.light_sources,scene.light_strengths = animation.lights_at(scene.light_sources,scene.light_strengths,tracks,frame)
+            expected = image_output.output_rows(render.render(scene,animation.camera_at(camera,tracks,frame))) #the pixel array as it appears in the saved image.
+            differences += differing_pixels(expected,np.asarray(Image.open(path).convert("RGB")))
+    return differences
+
+checks = {"vectorised":check_vectorised,"bvh":check_bvh,"store":check_store,"parallel":check_parallel,"png_output":check_png_output,"jit":check_jit,"progressive":check_progressive,"tile_cache":check_tile_cache,"animation":check_animation}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the renderers all give the same images.")
+    parser.add_argument("--resolution",type=int,default=24,help="the width and height of the test renders, in pixels")
+    arguments = parser.parse_args()
+    failed = False
+    for scene_name,get_description in test_scenes.items():
+        description = get_description()
+        for check_name,check in checks.items():
+            with contextlib.redirect_stdout(io.StringIO()): #hide the renderers' progress messages.
+                differences = check(description,arguments.resolution)
+            if(differences is None):
+                print(check_name+", "+scene_name+" scene: skipped")
+                continue
+            print(check_name+", "+scene_name+" scene: "+str(differences)+" differing pixels")
+            failed = failed or differences > 0
+    if(failed):
+        print("Parity check FAILED")
+        sys.exit(1)
+    print("All renders match")
+
+if __name__ == "__main__":
+    main()
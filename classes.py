@@ -1,5 +1,9 @@
 import numpy as np
-from PIL import Image
+
+from bvh import BVH
+import profiling
+from scene_store import SceneStore
+import textures
 class Material:
     def __init__(self,color=[255,255,255],diffusivity=1,specularity=0,shininess=1,reflectivity = 0.0): #a property of shapes that tell us how to reflect light from the shape.
         self.color = color #color of material
@@ -9,19 +13,33 @@ class Material:
         self.reflectivity = reflectivity
         
 class Ray: #a ray is a line (parametrised in t) which ends on one side. This means that there is a minimum value of t (take it as t = 0 here).
+    __slots__ = ("source","direction") #lots of rays get made, so they don't get a __dict__, and x0, x1 and so on just read the source and direction.
     def __init__(self,source,direction): #source and direction indicate where the ray starts and the direction it travels as t increases.
         self.source = source
         self.direction = direction
-        self.x0 = source[0]
-        self.x1 = direction[0]
-        self.y0 = source[1]
-        self.y1 = direction[1]
-        self.z0 = source[2]
-        self.z1 = direction[2]
+    x0 = property(lambda self: self.source[0])
+    x1 = property(lambda self: self.direction[0])
+    y0 = property(lambda self: self.source[1])
+    y1 = property(lambda self: self.direction[1])
+    z0 = property(lambda self: self.source[2])
+    z1 = property(lambda self: self.direction[2])
     def get_point(self,t):
-        return np.array([self.x0+self.x1*t,self.y0+self.y1*t,self.z0+self.z1*t])
+        return self.source+self.direction*t
 
-class Sphere:
+class Shape: #the things that all shapes (spheres, planes and sphere slices) can do using their "intersects" methods.
+    def occludes(self,ray,t_min = 0.0001,t_max = 1): #check whether the ray hits this shape with t_min < t < t_max. With the defaults, this says whether a shadow ray (which reaches its light at t = 1) is blocked by the shape.
+        trace = self.intersects(ray)
+        if(trace[2] and t_min<trace[0] and trace[0]<t_max):
+            return True
+        if(trace[3] and t_min<trace[1] and trace[1]<t_max):
+            return True
+        return False
+        
+    def occludes_batch(self,sources,directions,t_min = 0.0001,t_max = 1): #array version of "occludes" for (N,3) arrays of ray sources and directions.
+        t_0,t_1,hit_0,hit_1 = self.intersects_batch(sources,directions)
+        return (hit_0 & (t_min<t_0) & (t_0<t_max)) | (hit_1 & (t_min<t_1) & (t_1<t_max))
+        
+class Sphere(Shape):
     def __init__(self,centre,radius,material):
         self.centre = centre
         self.radius = radius
@@ -54,8 +72,36 @@ class Sphere:
     def get_color_at_point(self,point):
         return self.material.color
         
-class Plane:
-    def __init__(self,point,normal,material,texture_path = None,second_point = np.array([0,0,0]),tex_size = 100):
+    def intersects_batch(self,sources,directions): #array version of "intersects" for N rays at once, given as (N,3) arrays of sources and directions. Returns arrays of t_0, t_1 and the two hit flags, with the t-values set to 0 wherever the flag is False (same as "intersects").
+        profiling.count_tests(type(self).__name__,len(sources))
+        x0,y0,z0 = sources[:,0],sources[:,1],sources[:,2]
+        x1,y1,z1 = directions[:,0],directions[:,1],directions[:,2]
+        a = x1**2 + y1**2 + z1**2
+        b = 2*((x1*(x0-self.centre[0])) +(y1*(y0-self.centre[1]))+(z1*(z0-self.centre[2])))
+        c = (x0-self.centre[0])**2 +(y0-self.centre[1])**2+(z0-self.centre[2])**2 - (self.radius**2)
+        
+        discriminant = b**2 - (4*a*c)
+        hit = discriminant >= 0
+        root = np.sqrt(np.where(hit,discriminant,0)) #rays with no real solutions get a dummy root of 0, and are masked out below.
+        t_0 = (-b - root)/(2*a)
+        t_1 = (-b + root)/(2*a)
+        hit_0 = hit & ~((t_0<0) & (t_1>0)) #if the ray starts inside the sphere, only t_1 counts.
+        return np.where(hit_0,t_0,0),np.where(hit,t_1,0),hit_0,hit
+        
+    def get_normal_batch(self,points): #array version of "get_normal" for (N,3) points.
+        return (points-self.centre)/self.radius
+        
+    def get_color_batch(self,points,footprints = None): #array version of "get_color_at_point" for (N,3) points. Spheres have no texture, so footprints (see Plane.get_color_batch) aren't used.
+        return np.broadcast_to(np.asarray(self.material.color,dtype=float),np.shape(points))
+        
+    def get_bounds(self): #the corners (minimum and maximum x, y and z) of the smallest box that holds the sphere. Used to build a bounding volume hierarchy.
+        return self.centre-self.radius,self.centre+self.radius
+        
+    def get_packed(self): #the type of shape, the parameters that go in the packed scene store (see scene_store.py), and whether the shape is textured.
+        return "Sphere",(self.centre,self.radius),False
+        
+class Plane(Shape):
+    def __init__(self,point,normal,material,texture_path = None,second_point = np.array([0,0,0]),tex_size = 100,texture_image = None): #texture_image can be given instead of texture_path, to share an image that has already been loaded.
         self.point = point #a point in the plane
         self.normal = normalise(normal)#a vector that is normal to the plane
         self.d = np.dot(self.point,self.normal)#the constant that appears on the RHS in the equation defining the plane. Used to check which side of the plane a given point is on.
@@ -78,11 +124,33 @@ class Plane:
         self.tex_vec_2 = -np.cross(normal,self.tex_vec_1) #if tex_vec_1 is the x-axis, using the minus sign makes this a y-axis that points up.
         self.tex_size = tex_size #a tex_size of 100 means that 100 pixels in a texture image correspond to 1 unit in the scene space.
         
-        if(not(texture_path is None)): #try to get the texture image if one is given.
-            try:
-                self.texture_image = np.asarray(Image.open(texture_path,mode="r"))
-            except FileNotFoundError:
-                print("File not found: "+texture_path+", continuing using default colour of object")
+        self.texture_path = texture_path
+        self.shared_texture = False #whether the texture image came from the texture cache (and so can be reloaded from it).
+        self.mipmaps = None
+        if(not(texture_image is None)):
+            self.texture_image = texture_image
+        elif(not(texture_path is None)): #try to get the texture image if one is given.
+            self.load_texture()
+                
+    def load_texture(self): #get the texture image from the texture cache, which only decodes each texture file once and shares it between all the planes using it.
+        try:
+            self.texture_image = textures.load_texture(self.texture_path)
+            self.shared_texture = True
+        except FileNotFoundError:
+            print("File not found: "+self.texture_path+", continuing using default colour of object")
+            
+    def __getstate__(self): #when a plane is pickled (e.g. to send it to a worker process, or to save a scene cache), leave out the texture image if it came from the texture cache...
+        state = self.__dict__.copy()
+        state["mipmaps"] = None #the mip pyramid can be rebuilt from the texture when it is needed.
+        if(self.shared_texture):
+            state["texture_image"] = np.array([0])
+        return state
+        
+    def __setstate__(self,state): #...and get it back from the texture cache when the plane is unpickled, so that every process shares one memory-mapped copy.
+        self.__dict__.update(state)
+        if(self.shared_texture):
+            self.shared_texture = False
+            self.load_texture()
                 
     def get_normal(self,point):
         return self.normal
@@ -100,6 +168,35 @@ class Plane:
             
         return self.material.color
         
+    def get_color_batch(self,points,footprints = None): #array version of "get_color_at_point" for (N,3) points. Does the texture lookup for all of the points at once.
+        #footprints, if given, are how wide (in scene units) the patch of the plane seen by each ray is. The texture is then sampled from its
+        #mip pyramid, blurring it just enough that distant parts of the plane don't alias. Otherwise the nearest texture pixel is used.
+        if(not(np.array_equal(self.texture_image,np.array([0])))):
+            difference_vectors = points-self.point
+            x_coords = (difference_vectors@self.tex_vec_1)*self.tex_size
+            y_coords = (difference_vectors@self.tex_vec_2)*self.tex_size
+            if(footprints is None):
+                return textures.sample_nearest(self.texture_image,x_coords,y_coords)[:,:3].astype(float)
+            return textures.sample_mipmapped(self.get_mipmaps(),x_coords,y_coords,footprints*self.tex_size)[:,:3]
+            
+        return np.broadcast_to(np.asarray(self.material.color,dtype=float),np.shape(points))
+        
+    def get_mipmaps(self): #the mip pyramid of the texture, built the first time it is needed.
+        if(self.shared_texture): #planes sharing a texture from the texture cache share its mip pyramid too.
+            return textures.load_mipmaps(self.texture_path)
+        if(self.mipmaps is None):
+            self.mipmaps = textures.build_mipmaps(self.texture_image)
+        return self.mipmaps
+        
+    def get_normal_batch(self,points):
+        return np.broadcast_to(self.normal,np.shape(points))
+        
+    def get_bounds(self): #planes go on forever, so they can't be put in a bounding box.
+        return None
+        
+    def get_packed(self):
+        return "Plane",(self.normal,self.d),not(np.array_equal(self.texture_image,np.array([0])))
+        
     def intersects(self,ray): #maths to find the point of intersection of the plane with a ray. 
         if (np.dot(ray.direction,self.normal)==0):
             return [0,0,False,False]
@@ -108,12 +205,21 @@ class Plane:
             return [0,0,False,False]
         return [t_int,t_int,True,True] #return two values of t for consistency, since the sphere "intersects" method also returns two values of t.
         
+    def intersects_batch(self,sources,directions): #array version of "intersects" for (N,3) arrays of ray sources and directions.
+        profiling.count_tests(type(self).__name__,len(sources))
+        denominators = directions@self.normal
+        with np.errstate(divide="ignore",invalid="ignore"): #rays parallel to the plane divide by zero here, but they are masked out anyway.
+            t_int = (self.d - sources@self.normal)/denominators
+        hit = (denominators!=0) & (t_int>=0)
+        t_int = np.where(hit,t_int,0)
+        return t_int,t_int,hit,hit
+        
     def contains(self,check_point): #check if a point is "inside" the plane.
         if np.dot(check_point,self.normal)<=self.d:
             return True
         return False
 
-class SphereSlice: #a sphere with some of the surface cut away. Useful to make mirrors, specifically concave ones.        
+class SphereSlice(Shape): #a sphere with some of the surface cut away. Useful to make mirrors, specifically concave ones.        
     def __init__(self,edge_centre,radius,pole_dir,max_edge_dist,material):
         self.edge_centre = edge_centre #the centre of the slice (NOT the centre of the sphere it is "cut" from).
         self.radius = radius #radius of the underlying sphere.
@@ -123,7 +229,9 @@ class SphereSlice: #a sphere with some of the surface cut away. Useful to make m
         self.sphere_centre = self.edge_centre+self.pole #the centre of the underlying sphere.
         self.max_edge_dist = max_edge_dist #the distance from the point at the center of the slice, towards the sphere center, at which the slice gets cut off. 
         #E.g. setting max_edge_dist to 1 for a sphere with radius 1 would give a half-sphere.
-        self.cutoff_plane = Plane(self.edge_centre+(self.unit_pole*self.max_edge_dist),self.pole,self.material) #a plane separating the slice from the rest of the sphere
+        #the plane separating the slice from the rest of the sphere. Points with cutoff_normal.point <= cutoff_d are on the slice side.
+        self.cutoff_normal = normalise(self.pole)
+        self.cutoff_d = np.dot(self.edge_centre+(self.unit_pole*self.max_edge_dist),self.cutoff_normal)
         
     def intersects(self,ray):
         a = ray.x1**2 + ray.y1**2 + ray.z1**2
@@ -139,8 +247,8 @@ class SphereSlice: #a sphere with some of the surface cut away. Useful to make m
         t_0 = (-b - np.sqrt(discriminant))/(2*a) #note that we always have t_0 <= t_1
         t_1 = (-b + np.sqrt(discriminant))/(2*a)
 
-        cutoff_0 = self.cutoff_plane.contains(ray.get_point(t_0)) #use the cutoff plane to check if these t-values should be rendered as part of the slice
-        cutoff_1 = self.cutoff_plane.contains(ray.get_point(t_1)) #if the plane contains the points, they should be rendered.
+        cutoff_0 = np.dot(ray.get_point(t_0),self.cutoff_normal)<=self.cutoff_d #use the cutoff plane to check if these t-values should be rendered as part of the slice
+        cutoff_1 = np.dot(ray.get_point(t_1),self.cutoff_normal)<=self.cutoff_d #if the plane contains the points, they should be rendered.
         
         if(cutoff_0 and cutoff_1): #return the t-values depending on whether or not they were cut off.
             return [t_0,t_1,True,True]
@@ -150,6 +258,31 @@ class SphereSlice: #a sphere with some of the surface cut away. Useful to make m
             return [0,t_1,False,True]
         else:
             return [0,0,False,False]
+            
+    def intersects_batch(self,sources,directions): #array version of "intersects" for (N,3) arrays of ray sources and directions.
+        profiling.count_tests(type(self).__name__,len(sources))
+        x0,y0,z0 = sources[:,0],sources[:,1],sources[:,2]
+        x1,y1,z1 = directions[:,0],directions[:,1],directions[:,2]
+        a = x1**2 + y1**2 + z1**2
+        b = 2*((x1*(x0-self.sphere_centre[0])) +(y1*(y0-self.sphere_centre[1]))+(z1*(z0-self.sphere_centre[2])))
+        c = (x0-self.sphere_centre[0])**2 +(y0-self.sphere_centre[1])**2+(z0-self.sphere_centre[2])**2 - (self.radius**2)
+        
+        discriminant = b**2 - (4*a*c)
+        hit = discriminant >= 0
+        root = np.sqrt(np.where(hit,discriminant,0))
+        t_0 = (-b - root)/(2*a)
+        t_1 = (-b + root)/(2*a)
+        
+        cutoff_0 = hit & self.inside_cutoff_batch(sources,directions,t_0) #same check as in "intersects", for all the rays at once.
+        cutoff_1 = hit & self.inside_cutoff_batch(sources,directions,t_1)
+        return np.where(cutoff_0,t_0,0),np.where(cutoff_1,t_1,0),cutoff_0,cutoff_1
+        
+    def inside_cutoff_batch(self,sources,directions,t_values): #whether the points at t_values along the rays are on the slice side of the cutoff plane. Worked out the same way as in scene_store.slice_hits, so both give the same answer.
+        distances = 0
+        for axis in range(0,3):
+            distances = distances+(sources[:,axis]+directions[:,axis]*t_values)*self.cutoff_normal[axis]
+        return distances<=self.cutoff_d
+        
     def get_normal(self,point):
         x = point[0]
         y = point[1]
@@ -158,5 +291,142 @@ class SphereSlice: #a sphere with some of the surface cut away. Useful to make m
     def get_color_at_point(self,point):
         return self.material.color
         
+    def get_normal_batch(self,points):
+        return (points-self.sphere_centre)/self.radius
+        
+    def get_color_batch(self,points,footprints = None):
+        return np.broadcast_to(np.asarray(self.material.color,dtype=float),np.shape(points))
+        
+    def get_bounds(self): #the smallest box that holds the slice (rather than the whole sphere), so that small mirrors get small boxes.
+        cos_max_angle = np.clip(1-(self.max_edge_dist/self.radius),-1,1) #points on the slice are at most this angle away from the edge centre, as seen from the sphere centre.
+        max_angle = np.arccos(cos_max_angle)
+        edge_dir = -self.unit_pole #the direction from the sphere centre to the edge centre.
+        axis_angles = np.arccos(np.clip(edge_dir,-1,1)) #the angle between edge_dir and each of the x, y and z axes.
+        reverse_angles = np.pi-axis_angles
+        furthest_up = np.where(axis_angles<=max_angle,1,np.cos(axis_angles-max_angle)) #how far along each axis the slice reaches (as a fraction of the radius)...
+        furthest_down = np.where(reverse_angles<=max_angle,1,np.cos(reverse_angles-max_angle)) #...and how far it reaches in the opposite direction.
+        return self.sphere_centre-(self.radius*furthest_down),self.sphere_centre+(self.radius*furthest_up)
+        
+    def get_packed(self):
+        return "SphereSlice",(self.sphere_centre,self.radius,self.cutoff_normal,self.cutoff_d),False
+        
+class Hit: #a point where a ray hits an object. The normal and the colour of the surface there are worked out the first time they are needed, and then reused for every light source.
+    __slots__ = ("ray","t","object","point","normal","color")
+    def __init__(self,ray,t,object):
+        self.ray = ray
+        self.t = t
+        self.object = object
+        self.point = ray.get_point(t)
+        self.normal = None
+        self.color = None
+        
+    def get_normal(self):
+        if(self.normal is None):
+            self.normal = self.object.get_normal(self.point)
+        return self.normal
+        
+    def get_color(self):
+        if(self.color is None):
+            self.color = self.object.get_color_at_point(self.point)
+        return self.color
+        
+class Scene: #everything that needs to be known to render a scene, apart from the camera: the objects, the light sources and how many times reflected rays can bounce.
+    def __init__(self,objects,light_sources,light_strengths,reflection_limit = 4,texture_filter = "nearest"):
+        self.objects = objects
+        self.light_sources = light_sources
+        self.light_strengths = light_strengths
+        self.reflection_limit = reflection_limit
+        self.texture_filter = texture_filter #"nearest" uses the nearest texture pixel (like get_color_at_point). "mipmap" filters textures according to how much of them each pixel covers, which stops distant textures aliasing.
+        self.bvh = None #the bounding volume hierarchy used to speed up intersection tests. Only made when build_bvh is called.
+        self.last_occluders = {} #for each light source (by index), the object that blocked the most shadow rays last time. Nearby points are usually shadowed by the same object, so it gets tested first.
+        self.packed_geometry = None #what the objects looked like when the store (and the BVH) were made; see describe_objects.
+        self.packed_appearance = None
+        self.pack()
+        
+    def describe_objects(self): #a quick description of everything the packed store and the BVH are made from: the shape and position of each object, and its material. Comparing descriptions tells whether the objects have changed.
+        geometry = []
+        appearance = []
+        for object in self.objects:
+            name,parameters,textured = object.get_packed()
+            geometry.append((name,tuple(np.asarray(parameter,dtype=float).tobytes() for parameter in parameters)))
+            material = object.material
+            appearance.append((textured,np.asarray(material.color,dtype=float).tobytes(),material.diffusivity,material.specularity,material.shininess,material.reflectivity))
+        return geometry,appearance
+        
+    def pack(self): #copy the shapes and materials into a packed scene store, which the vectorised renderer intersects rays with. The renderers call this at the start of each render, so objects can be changed, added or removed between renders.
+        #The store, and the BVH if there is one, are only made again if the objects have changed since they were made, so a scene
+        #loaded from a scene cache keeps its BVH.
+        geometry,appearance = self.describe_objects()
+        if(geometry != self.packed_geometry or appearance != self.packed_appearance):
+            self.store = SceneStore(self.objects)
+        if(geometry != self.packed_geometry):
+            self.last_occluders = {} #these may be the indices of objects that have since moved or gone.
+            if(self.bvh is not None): #the boxes in the hierarchy may no longer fit the objects.
+                self.bvh = BVH(self.objects,self.bvh.leaf_size)
+        self.packed_geometry = geometry
+        self.packed_appearance = appearance
+        
+    def build_bvh(self,leaf_size = 4): #build a bounding volume hierarchy over the objects. Worth it for scenes with lots of spheres, unless the compiled kernels in jit_kernels.py are used (they are quicker without it).
+        #The hierarchy holds the bounds the objects had when it was built. pack() (which the renderers call at the start of each render) builds it again if the objects have moved since, so moving, adding or removing objects between renders is fine.
+        self.pack() #so that objects changed before now don't make pack() build the new hierarchy again.
+        self.bvh = BVH(self.objects,leaf_size)
+        
+    def occluded(self,sources,directions,light_index = None,t_min = 0.0001,t_max = 1): #check whether each of the (N,3) rays hits any object with t_min < t < t_max. A ray is not tested any further once something blocks it.
+        with profiling.stage("intersection"):
+            occluders = self.find_occluders(sources,directions,light_index,t_min,t_max)
+        return occluders>=0
+
+    def find_occluders(self,sources,directions,light_index = None,t_min = 0.0001,t_max = 1): #the index of the object blocking each ray, or -1 if nothing does.
+        occluders = np.full(len(sources),-1)
+        last_occluder = self.last_occluders.get(light_index)
+        if(last_occluder is not None):
+            occluders[self.objects[last_occluder].occludes_batch(sources,directions,t_min,t_max)] = last_occluder
+            
+        if(self.bvh is not None):
+            rays = np.flatnonzero(occluders<0)
+            if(len(rays) > 0):
+                occluders[rays] = self.bvh.occluders(sources[rays],directions[rays],t_min,t_max)
+        else:
+            rays = np.flatnonzero(occluders<0)
+            if(len(rays) > 0):
+                occluders[rays] = self.store.occluders(sources[rays],directions[rays],t_min,t_max)
+                    
+        if(light_index is not None and (occluders>=0).any()): #remember the object that blocked the most rays for next time.
+            self.last_occluders[light_index] = int(np.argmax(np.bincount(occluders[occluders>=0])))
+        return occluders
+        
+class Camera: #the viewpoint and the screen that primary rays are cast through. The screen is normal to the x-axis, so its x coordinate is fixed.
+    def __init__(self,viewpoint,screen_x,screen_y_min,screen_y_max,screen_z_min,screen_z_max,res_y,res_z):
+        self.viewpoint = viewpoint
+        self.screen_x = screen_x
+        self.screen_y_min = screen_y_min
+        self.screen_y_max = screen_y_max
+        self.screen_z_min = screen_z_min
+        self.screen_z_max = screen_z_max
+        self.res_y = res_y
+        self.res_z = res_z
+        self.screen_y_points = np.linspace(screen_y_min,screen_y_max,res_y) #the points on the screen that each pixel corresponds to.
+        self.screen_z_points = np.linspace(screen_z_min,screen_z_max,res_z)
+        
+    def get_pixel_spacing(self): #the distances between neighbouring points on the screen in the y and z directions.
+        y_spacing = (self.screen_y_max-self.screen_y_min)/max(self.res_y-1,1)
+        z_spacing = (self.screen_z_max-self.screen_z_min)/max(self.res_z-1,1)
+        return y_spacing,z_spacing
+        
+    def get_pixel_size(self): #the distance between neighbouring points on the screen. Each primary ray "sees" a patch of the scene this wide at the screen, growing with distance from the viewpoint.
+        y_spacing,z_spacing = self.get_pixel_spacing()
+        return max(abs(y_spacing),abs(z_spacing))
+        
+    def get_rays(self,i_indices,j_indices,offsets = None): #the sources and directions, as (N,3) arrays, of the primary rays through pixels (i,j). The rays start on the screen and point away from the viewpoint.
+        #offsets, if given, is an (N,2) array of how far (in pixels, in the y and z directions) each ray is moved from the centre of its pixel.
+        screen_y = self.screen_y_points[i_indices]
+        screen_z = self.screen_z_points[j_indices]
+        if(offsets is not None):
+            y_spacing,z_spacing = self.get_pixel_spacing()
+            screen_y = screen_y+offsets[:,0]*y_spacing
+            screen_z = screen_z+offsets[:,1]*z_spacing
+        screen_points = np.column_stack((np.full(len(i_indices),self.screen_x,dtype=float),screen_y,screen_z))
+        return screen_points,screen_points-self.viewpoint
+        
 def normalise(v):
     return v/np.linalg.norm(v)
\ No newline at end of file
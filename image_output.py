@@ -0,0 +1,70 @@
+# Writing PNG files a few rows at a time, so that a large render can be saved without ever holding the whole image in memory.
+# A PNG file is a list of chunks: a header (IHDR) giving the size of the image, the compressed pixel data in any number of IDAT chunks,
+# and an end marker (IEND). The pixel data is one zlib stream of all the rows, top to bottom, so rows can be compressed and written
+# out as soon as they are finished.
+import struct
+import zlib
+
+import numpy as np
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+
+class PNGWriter: #writes an RGB PNG file row by row. Use it as a context manager, or call close() once every row has been written.
+    def __init__(self,path,width,height,compression_level = 6):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.previous_row = np.zeros((width,3),dtype=np.uint8) #rows are stored as the difference from the row above (the PNG "Up" filter), which compresses better. The row above the first row counts as black.
+        self.compressor = zlib.compressobj(compression_level)
+        self.file = open(path,"wb")
+        self.file.write(png_signature)
+        self.write_chunk(b"IHDR",struct.pack(">IIBBBBB",width,height,8,2,0,0,0)) #8 bits per channel, RGB, no interlacing.
+
+    def write_chunk(self,chunk_type,data):
+        self.file.write(struct.pack(">I",len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack(">I",zlib.crc32(data,zlib.crc32(chunk_type))))
+
+    def write_rows(self,rows): #add the next rows of the image, given as a (rows,width,3) array of pixels, top row first.
+        rows = np.asarray(rows,dtype=np.uint8)
+        if(rows.shape[1:] != (self.width,3)):
+            raise ValueError("Expected rows of shape (n,"+str(self.width)+",3), got "+str(rows.shape))
+        if(self.rows_written+len(rows) > self.height):
+            raise ValueError("Too many rows for an image "+str(self.height)+" pixels high")
+        if(len(rows) == 0):
+            return
+        above = np.concatenate((self.previous_row[None],rows[:-1]))
+        filtered = np.empty((len(rows),1+3*self.width),dtype=np.uint8)
+        filtered[:,0] = 2 #the filter type of each row (2 is "Up").
+        filtered[:,1:] = (rows-above).reshape(len(rows),-1) #uint8 arithmetic wraps around, which is what the filter expects.
+        data = self.compressor.compress(filtered.tobytes())
+        if(len(data) > 0):
+            self.write_chunk(b"IDAT",data)
+        self.previous_row = rows[-1].copy()
+        self.rows_written += len(rows)
+
+    def close(self):
+        if(self.file.closed):
+            return
+        try:
+            if(self.rows_written != self.height):
+                raise ValueError("Only "+str(self.rows_written)+" of "+str(self.height)+" rows were written")
+            self.write_chunk(b"IDAT",self.compressor.flush())
+            self.write_chunk(b"IEND",b"")
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exception_type,exception,traceback):
+        if(exception_type is None):
+            self.close()
+        else:
+            self.file.close() #leave the unfinished file as it is, without hiding the original error.
+        return False
+
+def output_rows(strip): #turn a (res_y,n,3) strip of the pixel array, holding the columns j_start <= j < j_start+n, into the n rows of the final image they make up, top row first.
+    #save_image transposes the pixel array and rotates it by 180 degrees, so row r of the image is column res_z-1-r of the pixel array, reversed.
+    return np.transpose(strip[::-1,::-1],(1,0,2))
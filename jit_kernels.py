@@ -0,0 +1,198 @@
+# Compiled versions of the hottest parts of the vectorised renderer, used when Numba (https://numba.pydata.org) is installed.
+# NumPy works through a batch one operation at a time, making a temporary array for each step of, say, the sphere intersection test.
+# These kernels instead loop over the rays (spread over all CPU cores with prange) and do every step for one ray before moving on to
+# the next, testing it against each shape in the packed scene store in turn. The maths, and the rules for picking the closest hit,
+# are the same as in scene_store.py and render.add_color_batch.
+#
+# Numba is optional: if it isn't installed, "available" is False and the renderer uses the NumPy code instead. Setting "enabled" to
+# False does the same even when it is installed. The kernels are compiled the first time they are used, which takes a few seconds, and
+# the compiled code is cached on disk (in __pycache__), so later runs start straight away. Call warm_up() to compile them up front,
+# e.g. before timing a render.
+import numpy as np
+
+import profiling
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+available = numba is not None
+enabled = available #whether the renderer should use the compiled kernels.
+
+if(available):
+    numba.config.THREADING_LAYER = "workqueue" #Numba's own thread pool. Forking worker processes (as render_parallel does) after the TBB pool has started can leave the main process hanging when it exits.
+    jit = numba.njit(cache=True) #compile to machine code, and cache the result on disk.
+    parallel_jit = numba.njit(parallel=True,cache=True) #the same, with prange loops spread over all the CPU cores.
+    prange = numba.prange
+else: #without Numba, the functions below are left as (slow) plain Python. They aren't used.
+    jit = parallel_jit = lambda function: function
+    prange = range
+
+@jit
+def sphere_roots(x0,y0,z0,x1,y1,z1,cx,cy,cz,radius): #the two t-values at which a ray meets a sphere, and whether it meets it at all.
+    a = x1**2 + y1**2 + z1**2
+    b = 2*((x1*(x0-cx)) +(y1*(y0-cy))+(z1*(z0-cz)))
+    c = (x0-cx)**2 +(y0-cy)**2+(z0-cz)**2 - (radius**2)
+    discriminant = b**2 - (4*a*c)
+    if(discriminant < 0):
+        return 0.0,0.0,False
+    root = np.sqrt(discriminant)
+    return (-b - root)/(2*a),(-b + root)/(2*a),True
+
+@jit
+def intersect_sphere(x0,y0,z0,x1,y1,z1,centres,radii,s): #like Sphere.intersects_batch for one ray and sphere number s of the store. Returns t_0, t_1 and the two hit flags.
+    t_0,t_1,hit = sphere_roots(x0,y0,z0,x1,y1,z1,centres[s,0],centres[s,1],centres[s,2],radii[s])
+    if(not hit):
+        return 0.0,0.0,False,False
+    if(t_0<0 and t_1>0): #the ray starts inside the sphere, so only t_1 counts.
+        return 0.0,t_1,False,True
+    return t_0,t_1,True,True
+
+@jit
+def intersect_plane(x0,y0,z0,x1,y1,z1,normals,offsets,p): #like Plane.intersects_batch.
+    denominator = x1*normals[p,0]+y1*normals[p,1]+z1*normals[p,2]
+    if(denominator == 0):
+        return 0.0,0.0,False,False
+    t_int = (offsets[p]-(x0*normals[p,0]+y0*normals[p,1]+z0*normals[p,2]))/denominator
+    if(not(t_int >= 0)):
+        return 0.0,0.0,False,False
+    return t_int,t_int,True,True
+
+@jit
+def intersect_slice(x0,y0,z0,x1,y1,z1,centres,radii,cutoff_normals,cutoff_offsets,s): #like SphereSlice.intersects_batch.
+    t_0,t_1,hit = sphere_roots(x0,y0,z0,x1,y1,z1,centres[s,0],centres[s,1],centres[s,2],radii[s])
+    if(not hit):
+        return 0.0,0.0,False,False
+    nx,ny,nz = cutoff_normals[s,0],cutoff_normals[s,1],cutoff_normals[s,2]
+    cutoff_0 = ((0+(x0+x1*t_0)*nx)+(y0+y1*t_0)*ny)+(z0+z1*t_0)*nz <= cutoff_offsets[s] #the same sums, in the same order, as SphereSlice.inside_cutoff_batch.
+    cutoff_1 = ((0+(x0+x1*t_1)*nx)+(y0+y1*t_1)*ny)+(z0+z1*t_1)*nz <= cutoff_offsets[s]
+    return (t_0 if cutoff_0 else 0.0),(t_1 if cutoff_1 else 0.0),cutoff_0,cutoff_1
+
+@jit
+def keep_closer(t_0,t_1,k,min_t,min_index,max_t): #the closest hit so far, after testing object k. Ties go to the object that comes first in the list.
+    trace_t = t_0 if t_0>0 else (t_1 if t_1>0 else max_t)
+    if(trace_t<min_t or (trace_t==min_t and k<min_index and trace_t<max_t)):
+        return trace_t,k
+    return min_t,min_index
+
+@parallel_jit
+def closest_hit_kernel(sources,directions,sphere_indices,sphere_centres,sphere_radii,plane_indices,plane_normals,plane_offsets,slice_indices,slice_centres,slice_radii,cutoff_normals,cutoff_offsets,max_t,tests):
+    count = sources.shape[0]
+    min_t = np.empty(count)
+    min_index = np.empty(count,dtype=np.int64)
+    front_hit = np.empty(count,dtype=np.bool_)
+    for r in prange(count):
+        x0,y0,z0 = sources[r,0],sources[r,1],sources[r,2]
+        x1,y1,z1 = directions[r,0],directions[r,1],directions[r,2]
+        best_t = max_t
+        best_index = 0
+        front = False
+        for s in range(len(sphere_indices)):
+            t_0,t_1,hit_0,hit_1 = intersect_sphere(x0,y0,z0,x1,y1,z1,sphere_centres,sphere_radii,s)
+            best_t,best_index = keep_closer(t_0,t_1,sphere_indices[s],best_t,best_index,max_t)
+            front = front or t_0>0
+        for p in range(len(plane_indices)):
+            t_0,t_1,hit_0,hit_1 = intersect_plane(x0,y0,z0,x1,y1,z1,plane_normals,plane_offsets,p)
+            best_t,best_index = keep_closer(t_0,t_1,plane_indices[p],best_t,best_index,max_t)
+            front = front or t_0>0
+        for s in range(len(slice_indices)):
+            t_0,t_1,hit_0,hit_1 = intersect_slice(x0,y0,z0,x1,y1,z1,slice_centres,slice_radii,cutoff_normals,cutoff_offsets,s)
+            best_t,best_index = keep_closer(t_0,t_1,slice_indices[s],best_t,best_index,max_t)
+            front = front or t_0>0
+        min_t[r] = best_t
+        min_index[r] = best_index
+        front_hit[r] = front
+        tests[r,0] = len(sphere_indices)
+        tests[r,1] = len(plane_indices)
+        tests[r,2] = len(slice_indices)
+    return min_t,min_index,front_hit
+
+@jit
+def blocks(t_0,t_1,hit_0,hit_1,t_min,t_max):
+    return (hit_0 and t_min<t_0 and t_0<t_max) or (hit_1 and t_min<t_1 and t_1<t_max)
+
+@parallel_jit
+def occluders_kernel(sources,directions,sphere_indices,sphere_centres,sphere_radii,plane_indices,plane_normals,plane_offsets,slice_indices,slice_centres,slice_radii,cutoff_normals,cutoff_offsets,t_min,t_max,tests):
+    count = sources.shape[0]
+    occluders = np.full(count,-1,dtype=np.int64)
+    for r in prange(count): #each ray stops at the first object found in the way.
+        x0,y0,z0 = sources[r,0],sources[r,1],sources[r,2]
+        x1,y1,z1 = directions[r,0],directions[r,1],directions[r,2]
+        for s in range(len(sphere_indices)):
+            tests[r,0] += 1
+            t_0,t_1,hit_0,hit_1 = intersect_sphere(x0,y0,z0,x1,y1,z1,sphere_centres,sphere_radii,s)
+            if(blocks(t_0,t_1,hit_0,hit_1,t_min,t_max)):
+                occluders[r] = sphere_indices[s]
+                break
+        if(occluders[r] >= 0):
+            continue
+        for p in range(len(plane_indices)):
+            tests[r,1] += 1
+            t_0,t_1,hit_0,hit_1 = intersect_plane(x0,y0,z0,x1,y1,z1,plane_normals,plane_offsets,p)
+            if(blocks(t_0,t_1,hit_0,hit_1,t_min,t_max)):
+                occluders[r] = plane_indices[p]
+                break
+        if(occluders[r] >= 0):
+            continue
+        for s in range(len(slice_indices)):
+            tests[r,2] += 1
+            t_0,t_1,hit_0,hit_1 = intersect_slice(x0,y0,z0,x1,y1,z1,slice_centres,slice_radii,cutoff_normals,cutoff_offsets,s)
+            if(blocks(t_0,t_1,hit_0,hit_1,t_min,t_max)):
+                occluders[r] = slice_indices[s]
+                break
+    return occluders
+
+@parallel_jit
+def phong_kernel(colors,unit_normals,shadow_vects,unit_views,diffusivity,specularity,shininess,light_strength): #the colour that a light adds to each lit point, like the end of render.add_color_batch.
+    count = colors.shape[0]
+    added = np.empty((count,3),dtype=np.int64)
+    for r in prange(count):
+        length = np.sqrt(shadow_vects[r,0]**2+shadow_vects[r,1]**2+shadow_vects[r,2]**2)
+        sx,sy,sz = shadow_vects[r,0]/length,shadow_vects[r,1]/length,shadow_vects[r,2]/length
+        nx,ny,nz = unit_normals[r,0],unit_normals[r,1],unit_normals[r,2]
+        shadow_dot = nx*sx+ny*sy+nz*sz
+        reflection_x,reflection_y,reflection_z = 2*shadow_dot*nx-sx,2*shadow_dot*ny-sy,2*shadow_dot*nz-sz
+        diffuse_brightness = light_strength*abs(shadow_dot)*diffusivity[r]
+        specular_dot = (reflection_x*unit_views[r,0]+reflection_y*unit_views[r,1]+reflection_z*unit_views[r,2])**shininess[r]
+        specular_brightness = light_strength*specularity[r]*(specular_dot if specular_dot>0 else 0.0) #NaNs become 0, like they do with max().
+        for channel in range(3):
+            added[r,channel] = int(min(255.0,colors[r,channel]*(diffuse_brightness+specular_brightness)))
+    return added
+
+shape_names = ("Sphere","Plane","SphereSlice") #the order of the columns of the "tests" arrays.
+
+def count_tests(tests): #add the numbers of intersection tests done by a kernel to the profiling counts.
+    for name,number in zip(shape_names,tests.sum(axis=0)):
+        if(number > 0):
+            profiling.count_tests(name,number)
+
+def closest_hit(packed,sources,directions,max_t): #the compiled version of SceneStore.closest_hit. "packed" is SceneStore.get_jit_arrays().
+    tests = np.zeros((len(sources),3),dtype=np.int64)
+    result = closest_hit_kernel(np.ascontiguousarray(sources,dtype=float),np.ascontiguousarray(directions,dtype=float),*packed,float(max_t),tests)
+    count_tests(tests)
+    return result
+
+def occluders(packed,sources,directions,t_min,t_max): #the compiled version of SceneStore.occluders.
+    tests = np.zeros((len(sources),3),dtype=np.int64)
+    result = occluders_kernel(np.ascontiguousarray(sources,dtype=float),np.ascontiguousarray(directions,dtype=float),*packed,float(t_min),float(t_max),tests)
+    count_tests(tests)
+    return result
+
+def phong(colors,unit_normals,shadow_vects,unit_views,diffusivity,specularity,shininess,light_strength):
+    arrays = [np.ascontiguousarray(array,dtype=float) for array in (colors,unit_normals,shadow_vects,unit_views,diffusivity,specularity,shininess)]
+    return phong_kernel(*arrays,float(light_strength))
+
+def set_threads(count): #how many threads the kernels in this process spread their rays over. Worker processes call this so that a pool of them doesn't start a full set of threads each. Does nothing if Numba isn't installed.
+    if(available):
+        numba.set_num_threads(max(1,min(count,numba.config.NUMBA_NUM_THREADS)))
+
+def warm_up(): #compile the kernels now (or load them from the disk cache), rather than in the middle of the first render. Does nothing if Numba isn't installed.
+    if(not available):
+        return
+    rays = np.array([[0.0,0.0,0.0]])
+    empty = np.zeros(0,dtype=np.int64)
+    packed = (empty,np.zeros((0,3)),np.zeros(0),empty,np.zeros((0,3)),np.zeros(0),empty,np.zeros((0,3)),np.zeros(0),np.zeros((0,3)),np.zeros(0))
+    closest_hit(packed,rays,rays+1,10000)
+    occluders(packed,rays,rays+1,0.0001,1)
+    phong(rays,rays,rays+1,rays,np.ones(1),np.ones(1),np.ones(1),1)
@@ -0,0 +1,65 @@
+# Counters and timers for finding out where the vectorised renderer spends its time.
+# The renderer counts the rays it traces (primary, shadow and reflection rays) and the intersection tests done against each type of
+# shape, and times each stage of the render (intersection, shading, texturing and image output). Stages can be nested, e.g. the shadow
+# rays are traced in the middle of shading; time spent in a nested stage only counts towards that stage, so the stage times add up to
+# the time spent rendering.
+# The counts are kept for the current process, and build up until reset() is called. Use report() or save_report() to get them.
+import json
+import time
+from collections import Counter
+
+ray_counts = Counter() #"primary", "shadow" and "reflection" rays traced.
+intersection_tests = Counter() #ray-shape intersection tests, by type of shape (e.g. "Sphere").
+stage_times = Counter() #seconds spent in each stage.
+stage_stack = [] #the stages currently running, innermost last, as [name, time the stage (re)started].
+
+def reset(): #clear all the counters.
+    ray_counts.clear()
+    intersection_tests.clear()
+    stage_times.clear()
+    stage_stack.clear()
+
+def count_rays(kind,number):
+    ray_counts[kind] += int(number)
+
+def count_tests(shape_type,number): #count "number" ray-shape intersection tests against shapes of type shape_type (e.g. "Sphere").
+    intersection_tests[shape_type] += int(number)
+
+class stage: #a context manager that times a stage of the render, e.g. "with profiling.stage("shading"):".
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        now = time.perf_counter()
+        if(len(stage_stack) > 0): #pause the stage this one is nested in.
+            outer = stage_stack[-1]
+            stage_times[outer[0]] += now-outer[1]
+        stage_stack.append([self.name,now])
+        return self
+
+    def __exit__(self,*exception):
+        now = time.perf_counter()
+        name,started = stage_stack.pop()
+        stage_times[name] += now-started
+        if(len(stage_stack) > 0): #carry on timing the outer stage.
+            stage_stack[-1][1] = now
+        return False
+
+def report(): #the counts so far, as a dictionary that can be saved as JSON.
+    return {
+        "rays":dict(ray_counts),
+        "total_rays":sum(ray_counts.values()),
+        "intersection_tests":dict(intersection_tests),
+        "stage_seconds":dict(stage_times),
+    }
+
+def merge(other_report): #add the counts from a report made in another process (e.g. a worker used by render.render_parallel).
+    ray_counts.update(other_report["rays"])
+    intersection_tests.update(other_report["intersection_tests"])
+    stage_times.update(other_report["stage_seconds"])
+
+def save_report(path,extra = None): #save report() as a JSON file, along with anything in the dictionary "extra".
+    contents = dict(extra or {})
+    contents.update(report())
+    with open(path,"w") as report_file:
+        json.dump(contents,report_file,indent=2)
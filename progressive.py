@@ -0,0 +1,127 @@
+# Rendering modes for quick feedback while working on a scene.
+#
+# Progressive rendering traces a coarse preview first (every 8th pixel in each direction, say), saves it, and then fills in the
+# pixels in between, halving the spacing each pass until every pixel has been traced. No pixel is traced twice.
+#
+# Incremental rendering keeps the tiles of the last render in a tile cache. Each cached tile is stored with a key made from
+# everything that can change how the tile looks, so after a change to the scene only the tiles affected by it are rendered again:
+#   - the camera and the position of the tile on the screen, the reflection limit and texture filter, and the shape and position of
+#     every object (any of them could move into view, or into the way of a shadow ray).
+#   - for tiles where at least one ray hit something: the light sources, and the materials and textures of the objects seen in the
+#     tile, either directly or in reflections. So changing the material of one object only re-renders the tiles where it shows up,
+#     and tiles that show nothing at all survive changes to the lights and materials.
+import hashlib
+import os
+
+import numpy as np
+
+import render
+from classes import Sphere,Plane,SphereSlice
+
+def render_progressive(scene,camera,preview_path = None,start_step = 8): #render the screen coarse-to-fine, starting with every start_step-th pixel. After each pass the preview (with the gaps filled in from the nearest traced pixel) is saved to preview_path, if given. Returns the finished pixel array.
+    scene.pack()
+    pixels = np.full((camera.res_y,camera.res_z,3),127,dtype=np.uint8)
+    traced = np.zeros((camera.res_y,camera.res_z),dtype=bool)
+    step = start_step
+    while(step >= 1):
+        i_indices,j_indices = np.meshgrid(np.arange(0,camera.res_y,step),np.arange(0,camera.res_z,step),indexing="ij")
+        new = ~traced[i_indices,j_indices] #pixels traced in earlier (coarser) passes are skipped.
+        i_indices = i_indices[new]
+        j_indices = j_indices[new]
+        pixels[i_indices,j_indices] = render.render_pixels(scene,camera,i_indices,j_indices)
+        traced[i_indices,j_indices] = True
+        print("Progressive pass with step "+str(step)+": traced "+str(len(i_indices))+" pixels")
+        if(preview_path is not None):
+            render.save_image(fill_gaps(pixels,traced,step),preview_path)
+        step //= 2
+    return pixels
+
+def fill_gaps(pixels,traced,step): #a preview image, where each pixel that hasn't been traced yet copies the traced pixel at the top left corner of its step x step block.
+    i_blocks = (np.arange(pixels.shape[0])//step)*step
+    j_blocks = (np.arange(pixels.shape[1])//step)*step
+    preview = pixels[i_blocks][:,j_blocks]
+    preview[traced] = pixels[traced]
+    return preview
+
+def hash_parts(hasher,*parts): #add numbers, strings and arrays to a hash.
+    for part in parts:
+        if(isinstance(part,np.ndarray)):
+            hasher.update(str((part.dtype,part.shape)).encode())
+            hasher.update(np.ascontiguousarray(part).tobytes())
+        else:
+            hasher.update(repr(part).encode())
+        hasher.update(b"|")
+
+def describe_geometry(object): #everything about an object that decides which rays hit it.
+    if(isinstance(object,Sphere)):
+        return ["sphere",np.asarray(object.centre,dtype=float),object.radius]
+    if(isinstance(object,Plane)):
+        return ["plane",np.asarray(object.point,dtype=float),object.normal]
+    if(isinstance(object,SphereSlice)):
+        return ["slice",np.asarray(object.edge_centre,dtype=float),object.radius,object.unit_pole,object.max_edge_dist]
+    return [type(object).__name__,repr(vars(object))]
+
+def describe_appearance(object): #everything about an object that decides how it looks once it has been hit.
+    material = object.material
+    parts = [list(material.color),material.diffusivity,material.specularity,material.shininess,material.reflectivity]
+    if(isinstance(object,Plane)):
+        parts += [object.tex_vec_1,object.tex_vec_2,object.tex_size]
+        if(object.shared_texture): #textures from the texture cache are identified by their file and when it was last changed.
+            parts += [os.path.abspath(object.texture_path),os.stat(object.texture_path).st_mtime_ns]
+        else:
+            parts += [np.asarray(object.texture_image)]
+    return parts
+
+def scene_hashes(scene,camera): #hash the parts of the scene that tile keys are made from: the geometry (shared by every tile), the lights, and the appearance of each object.
+    geometry = hashlib.sha256()
+    hash_parts(geometry,camera.viewpoint,camera.screen_x,camera.screen_y_min,camera.screen_y_max,camera.screen_z_min,camera.screen_z_max,camera.res_y,camera.res_z)
+    hash_parts(geometry,scene.reflection_limit,scene.texture_filter,len(scene.objects))
+    for object in scene.objects:
+        hash_parts(geometry,*describe_geometry(object))
+    lighting = hashlib.sha256()
+    hash_parts(lighting,*[np.asarray(light,dtype=float) for light in scene.light_sources],list(scene.light_strengths))
+    appearances = []
+    for object in scene.objects:
+        appearance = hashlib.sha256()
+        hash_parts(appearance,*describe_appearance(object))
+        appearances.append(appearance.hexdigest())
+    return geometry.hexdigest(),lighting.hexdigest(),appearances
+
+def tile_key(hashes,tile,seen_objects): #the key a tile is cached under, given the scene hashes and the objects that were seen in the tile.
+    geometry,lighting,appearances = hashes
+    hasher = hashlib.sha256()
+    hash_parts(hasher,geometry,tuple(tile),sorted(seen_objects))
+    if(len(seen_objects) > 0): #tiles that show nothing don't depend on the lights or materials.
+        hash_parts(hasher,lighting,*[appearances[k] for k in sorted(seen_objects)])
+    return hasher.hexdigest()
+
+def tile_cache_path(cache_dir,tile):
+    return os.path.join(cache_dir,"tile_"+"_".join(str(edge) for edge in tile)+".npz")
+
+def render_incremental(scene,camera,cache_dir,tile_size = 64): #render the screen in tiles, reusing any tiles in cache_dir that the scene hasn't changed since they were rendered. Returns the pixel array.
+    os.makedirs(cache_dir,exist_ok=True)
+    scene.pack()
+    pixels = np.full((camera.res_y,camera.res_z,3),127,dtype=np.uint8)
+    hashes = scene_hashes(scene,camera)
+    tiles = render.get_tiles(camera,tile_size)
+    rendered = 0
+    for tile in tiles:
+        i_start,i_stop,j_start,j_stop = tile
+        cache_path = tile_cache_path(cache_dir,tile)
+        try:
+            with np.load(cache_path) as cached:
+                if(str(cached["key"]) == tile_key(hashes,tile,cached["seen_objects"].tolist())):
+                    pixels[i_start:i_stop,j_start:j_stop] = cached["pixels"]
+                    continue
+        except (OSError,KeyError,ValueError):
+            pass #no usable cached tile, so render it.
+
+        seen_objects = set()
+        pixels[i_start:i_stop,j_start:j_stop] = render.render_tile(scene,camera,i_start,i_stop,j_start,j_stop,seen_objects)
+        rendered += 1
+        key = tile_key(hashes,tile,seen_objects)
+        temp_path = cache_path+"."+str(os.getpid())+".tmp.npz"
+        np.savez(temp_path,key=key,seen_objects=np.array(sorted(seen_objects),dtype=int),pixels=pixels[i_start:i_stop,j_start:j_stop])
+        os.replace(temp_path,cache_path)
+    print("Rendered "+str(rendered)+" of "+str(len(tiles))+" tiles; the rest were reused from "+cache_dir)
+    return pixels
@@ -1,14 +1,37 @@
 # Cian McDonnell 2020
 # Feel free to use or edit this code as you wish, but please credit me as the creator.
 import numpy as np
-from PIL import Image
+import sys
 import time
 
-from classes import Ray,Sphere,Plane,SphereSlice,Material #all the classes defined for the project in another file
+from classes import Ray,Sphere,Plane,SphereSlice,Material,Scene,Camera,Hit #all the classes defined for the project in another file
+import render #the vectorised renderer
+import scene_file #loading scenes from scene files
+import progressive #progressive and incremental rendering
+import antialiasing #adaptive anti-aliasing
+import jit_kernels #compiled kernels, used if Numba is installed
+import profiling #ray counts and stage timings for the vectorised renderer
 
 res_y = 1500
 res_z = 1500
 
+batched = True #if True, use the vectorised renderer in render.py, which traces whole rows of pixels at once. If False, use the (much slower) per-pixel cast_ray loop below.
+rows_per_batch = 10 #how many rows of pixels the vectorised renderer traces at once.
+workers = 1 #how many processes the vectorised renderer uses. With more than one, the screen is split into tiles which are rendered in parallel. None uses one process per CPU.
+tile_size = 64 #the width and height (in pixels) of the tiles used when rendering with several processes.
+texture_filter = "nearest" #"nearest" uses the nearest pixel of a texture, like get_color_at_point. "mipmap" (vectorised renderer only) filters textures according to how much of them each pixel covers, which stops distant textures aliasing.
+progressive_step = None #if set (e.g. to 8), the vectorised renderer first traces every progressive_step-th pixel, saves a preview to output.png, and then fills in the rest, halving the spacing each pass.
+tile_cache_dir = None #if set (e.g. to "tile_cache"), the vectorised renderer keeps the tiles it renders in this folder, and only renders again the tiles that have changed since the last render.
+adaptive_samples = None #if set (e.g. to 8), the vectorised renderer anti-aliases the image: after tracing one ray per pixel, it traces this many extra rays through each pixel on an edge (where neighbouring pixels show different objects, or differ in colour by more than edge_threshold), and averages them.
+edge_threshold = 16
+sample_budget = None #the most extra rays to trace when anti-aliasing. If there are too many edge pixels, the ones with the most contrast get the extra rays.
+stream_output = False #if True, the vectorised renderer writes output.png a few rows at a time as it renders, rather than keeping the whole image in memory. Use this for very large images.
+profile_path = None #if set (e.g. to "profile.json"), save the vectorised renderer's ray counts, intersection test counts and time spent per stage to this file as JSON.
+use_jit = True #if True (and Numba is installed), the vectorised renderer uses the compiled kernels in jit_kernels.py for intersections and shading. If False, or if Numba isn't installed, it uses NumPy.
+use_bvh = False #if True, the vectorised renderer puts the spheres in a bounding volume hierarchy so that rays only get tested against objects near them. Makes a big difference for scenes with lots of spheres when rendering with NumPy, but the hierarchy is walked with NumPy even when Numba is installed, and the compiled kernels (see use_jit) test every object quicker than that. For the few objects here it is quicker to test them all either way.
+
+jit_kernels.enabled = use_jit and jit_kernels.available #set here rather than in the main block, so that worker processes pick it up too.
+
 start = time.time()
 
 screen_y_min = -0.9 #the y and z boundaries of the screen. The screen is normal to the x-axis, so its x coordinate is fixed.
@@ -53,6 +76,11 @@ wall2 = Plane(np.array([5,0,0]),np.array([-1,0,0]),brick,second_point = np.array
 
 
 objects = [sphere1,sphere2,ground,wall1,wall2] #all the objects are in a list to make it easy to iterate through them.
+
+scene = Scene(objects,light_sources,light_strengths,reflection_limit,texture_filter) #the same scene and screen, bundled up for the vectorised renderer.
+camera = Camera(viewpoint,screen_x,screen_y_min,screen_y_max,screen_z_min,screen_z_max,res_y,res_z)
+if(use_bvh):
+    scene.build_bvh()
     
 def normalise(v):
     return v/np.linalg.norm(v)
@@ -60,73 +88,77 @@ def normalise(v):
 
 
 
-def add_color(prim_ray,intersection_point,intersecting_object,light_source,light_strength,min_prim_t): #calculates what color a pixel should be due to light falling on an object
-    global objects
-    
-    lit = True
-    
+def in_shadow(shadow_ray,light_index): #check whether anything blocks the shadow ray (anything hit with 0.0001 < t < 1) and stop at the first object that does.
+    last_occluder = scene.last_occluders.get(light_index) #the object that blocked the last shadow ray to this light. Neighbouring pixels are usually shadowed by the same object, so try it first.
+    if(last_occluder is not None and objects[last_occluder].occludes(shadow_ray)):
+        return True
+    for k in range(0,len(objects)):
+        if(k != last_occluder and objects[k].occludes(shadow_ray)):
+            scene.last_occluders[light_index] = k
+            return True
+    return False
 
-    shadow_vect = light_source-intersection_point
-    shadow_ray = Ray(intersection_point,shadow_vect)
-    unit_shadow_vect = normalise(shadow_vect)
-    
-    
-    shadow_traces = [object.intersects(shadow_ray) for object in objects] #can tell us whether the shadow ray hits any objects on its journey to the light source
+def add_color(hit,light_index): #calculates what color a pixel should be due to light falling on an object
+    light_source = light_sources[light_index]
+    light_strength = light_strengths[light_index]
+    intersecting_object = hit.object
     
+    color = np.array([0,0,0],dtype=np.uint8) #set the colour to 0 initially, then change it if the object is lit.
+
+    shadow_vect = light_source-hit.point
+    shadow_ray = Ray(hit.point,shadow_vect)
     
     if isinstance(intersecting_object,SphereSlice): #if the object is a SphereSlice, we can sometimes simultaneously see both the inside and outside. Make sure that a given light source does not light up both inside and outside.
         #go "back" along the primary ray to see if we are looking from the inside or outside.
-        looking_from_outside = np.linalg.norm(prim_ray.get_point(min_prim_t-(0.01*intersecting_object.radius))-intersecting_object.sphere_centre)>intersecting_object.radius 
+        looking_from_outside = np.linalg.norm(hit.ray.get_point(hit.t-(0.01*intersecting_object.radius))-intersecting_object.sphere_centre)>intersecting_object.radius 
         #check which side the light source is on.
         
         lit_from_outside = np.linalg.norm(shadow_ray.get_point(0.01*intersecting_object.radius)-intersecting_object.sphere_centre)>intersecting_object.radius
         if(lit_from_outside ^ looking_from_outside): #xor to check if the viewer is on the opposite side to the light source. If so, the light source can't see that part of the slice.
-            lit = False
+            return color
     
-    for shadow_trace in shadow_traces: #this checks the t-values at which the shadow ray hit objects, if it hit any at all. If there is a t-value between 0 and 1, there is an object blocking the light, so set "lit" to False.
-        if(shadow_trace[2]):
-            if(0.0001<shadow_trace[0] and shadow_trace[0]<1):
-                lit = False
-        if(shadow_trace[3]):
-            if(0.0001<shadow_trace[1] and shadow_trace[1]<1):
-                lit = False
-
-
-    color = np.array([0,0,0],dtype=np.uint8) #set the colour to 0 initially, then change it if the object is lit.
+    if(in_shadow(shadow_ray,light_index)): #if there is an object between the point and the light source, the light can't reach the point.
+        return color
     
-    if(lit): #If the primary ray hit a lit part of the object, light it up based on the angle to the light, and its material properties
-        normal = normalise(intersecting_object.get_normal(intersection_point))
-        reflection_vector = (2*np.dot(unit_shadow_vect,normal)*normal) - unit_shadow_vect #reflection of the shadow vector at the point of incidence (if it were going from light source to surface)
+    #the primary ray hit a lit part of the object, so light it up based on the angle to the light, and its material properties
+    unit_shadow_vect = normalise(shadow_vect)
+    normal = normalise(hit.get_normal())
+    reflection_vector = (2*np.dot(unit_shadow_vect,normal)*normal) - unit_shadow_vect #reflection of the shadow vector at the point of incidence (if it were going from light source to surface)
 
-        diffuse_brightness = light_strength*np.abs(np.dot(normal,unit_shadow_vect))*intersecting_object.material.diffusivity #add diffuse brightness
-        specular_brightness = light_strength*intersecting_object.material.specularity*max(0,np.dot(reflection_vector,normalise(-prim_ray.direction))**intersecting_object.material.shininess) #specular brightness
-        
-        red_col = int(min(255,intersecting_object.get_color_at_point(intersection_point)[0]*(diffuse_brightness+specular_brightness)))
-        green_col = int(min(255,intersecting_object.get_color_at_point(intersection_point)[1]*(diffuse_brightness+specular_brightness)))
-        blue_col = int(min(255,intersecting_object.get_color_at_point(intersection_point)[2]*(diffuse_brightness+specular_brightness)))
-        color=[red_col,green_col,blue_col]
+    diffuse_brightness = light_strength*np.abs(np.dot(normal,unit_shadow_vect))*intersecting_object.material.diffusivity #add diffuse brightness
+    specular_brightness = light_strength*intersecting_object.material.specularity*max(0,np.dot(reflection_vector,normalise(-hit.ray.direction))**intersecting_object.material.shininess) #specular brightness
+    
+    surface_color = hit.get_color()
+    red_col = int(min(255,surface_color[0]*(diffuse_brightness+specular_brightness)))
+    green_col = int(min(255,surface_color[1]*(diffuse_brightness+specular_brightness)))
+    blue_col = int(min(255,surface_color[2]*(diffuse_brightness+specular_brightness)))
+    color=[red_col,green_col,blue_col]
     return color
             
 
-def add_reflection(incident_ray,intersection_point,intersecting_object,normal,color_total,count,min_prim_t): #recursive function that bounces light off an object and adds up contributions from reflections that reach that point
+def add_reflection(hit,color_total,count): #recursive function that bounces light off an object and adds up contributions from reflections that reach that point
     global light_sources,light_strengths,objects
     
+    incident_ray = hit.ray
+    intersecting_object = hit.object
+    normal = hit.get_normal()
+    
     if(count == reflection_limit): #if we reach the maximum allowed number of reflections, stop
         return color_total
         
     min_reflected_t = 10000
     
     min_index = 0
-    hit = False
+    reflected_hit = False
     
     #Note: the normal should have length 1. As of now, all shapes in the program return normals of length 1 so this is OK.
     reflected_vect = incident_ray.direction - 2*np.dot(incident_ray.direction,normal)*normal #vector maths to calculate the vector that is parallel to the reflected ray
-    reflected_ray = Ray(intersection_point+(0.001*reflected_vect),reflected_vect) #start off the reflected ray a bit out from the old object (hence the 0.001) to prevent the ray intersecting with the object itself.
+    reflected_ray = Ray(hit.point+(0.001*reflected_vect),reflected_vect) #start off the reflected ray a bit out from the old object (hence the 0.001) to prevent the ray intersecting with the object itself.
     
     hit_infos = [object.intersects(reflected_ray) for object in objects] #checking which object the reflected ray hits first, similar to looking at the primary ray in the "cast_ray" function.
     for info in hit_infos:
         if((info[2] and info[0]>0) or (info[3] and info[0]>0)):
-            hit = True
+            reflected_hit = True
         if(info[0]<=0 and info[1]>0):
             if(info[1]<min_reflected_t):
                 min_index = hit_infos.index(info)
@@ -135,23 +167,18 @@ def add_reflection(incident_ray,intersection_point,intersecting_object,normal,co
             if(info[0]<min_reflected_t):
                 min_index = hit_infos.index(info)
                 min_reflected_t = info[0]
-    if(hit):                
-        next_point = reflected_ray.get_point(min_reflected_t)#the point hit by the reflected ray. Can recursively see what gets reflected onto THIS point.
-        next_object = objects[min_index]
-        
-
-    if(not hit):
+    if(not reflected_hit):
         return color_total
         
-    next_normal = next_object.get_normal(next_point)
+    next_hit = Hit(reflected_ray,min_reflected_t,objects[min_index])#the point hit by the reflected ray. Can recursively see what gets reflected onto THIS point.
     
     for a in range(0,len(light_sources)): #get the colour of the new object at the reflected ray
-        new_obj_color = add_color(reflected_ray,next_point,next_object,light_sources[a],light_strengths[a],min_reflected_t)
+        new_obj_color = add_color(next_hit,a)
         for b in range(0,3):
             color_total[b] = color_total[b] + int((intersecting_object.material.reflectivity**(1+count))*new_obj_color[b])
             
-    if(not next_object.material.reflectivity==0):#if the next object also happens to reflect, run this function again to see what it shows    
-        return add_reflection(reflected_ray,next_point,next_object,next_normal,color_total,count+1,min_reflected_t)
+    if(not next_hit.object.material.reflectivity==0):#if the next object also happens to reflect, run this function again to see what it shows    
+        return add_reflection(next_hit,color_total,count+1)
         
     return color_total
     
@@ -160,6 +187,20 @@ screen_z_points = np.linspace(screen_z_min,screen_z_max,res_z)
 
 pixels = np.full((res_y,res_z,3),127,dtype=np.uint8) #initialise each pixel to grey
 
+def use_scene(new_scene,new_camera): #render a different scene and camera (e.g. ones loaded from a scene file) instead of the ones defined above.
+    global scene,camera,objects,light_sources,light_strengths,reflection_limit,viewpoint,screen_x,screen_y_points,screen_z_points,pixels
+    scene = new_scene
+    camera = new_camera
+    objects = scene.objects
+    light_sources = scene.light_sources
+    light_strengths = scene.light_strengths
+    reflection_limit = scene.reflection_limit
+    viewpoint = camera.viewpoint
+    screen_x = camera.screen_x
+    screen_y_points = camera.screen_y_points
+    screen_z_points = camera.screen_z_points
+    pixels = np.full((camera.res_y,camera.res_z,3),127,dtype=np.uint8)
+
 def cast_ray(screen_x,screen_y,screen_z,i,j): #cast a ray from a point on the screen, and see if it hits an object in the scene. If so, color the pixel corresponding to that point.
     global pixels
     global viewpoint
@@ -185,14 +226,15 @@ def cast_ray(screen_x,screen_y,screen_z,i,j): #cast a ray from a point on the sc
                 min_index = traces.index(trace)
                 min_prim_t = trace[0]
                 
-    intersection_point = primary_ray.get_point(min_prim_t) #whatever object is closest to the screen should be the one that gets rendered.
-    intersecting_object = objects[min_index]
+    prim_hit = Hit(primary_ray,min_prim_t,objects[min_index]) #whatever object is closest to the screen should be the one that gets rendered.
+    intersection_point = prim_hit.point
+    intersecting_object = prim_hit.object
     if(hit): #adjust color using the "add_color" and "add_reflection" functions.
         pixels[i][j] = 0
         if(not intersecting_object.material.reflectivity == 0):
-            reflection_color = add_reflection(primary_ray,intersection_point,intersecting_object,intersecting_object.get_normal(intersection_point),np.array([0,0,0]),0,min_prim_t)
+            reflection_color = add_reflection(prim_hit,np.array([0,0,0]),0)
         for k in range(0,len(light_sources)):
-            color_to_add = add_color(primary_ray,intersection_point,intersecting_object,light_sources[k],light_strengths[k],min_prim_t)
+            color_to_add = add_color(prim_hit,k)
             
             pixels[i][j][0] = min(255,pixels[i][j][0]+color_to_add[0])
             pixels[i][j][1] = min(255,pixels[i][j][1]+color_to_add[1])
@@ -206,18 +248,35 @@ def cast_ray(screen_x,screen_y,screen_z,i,j): #cast a ray from a point on the sc
         if(i%100==0 and j%100==0):
             print(str(i)+", "+str(j)+", "+str(intersection_point)) #print the i and j values every so often so that we know how the render is progressing.
 
-for i in range(0,len(screen_y_points)): #cast rays at all the points on the screen.
-    for j in range(0,len(screen_z_points)):
-        cast_ray(screen_x,screen_y_points[i],screen_z_points[j],i,j)
-
-
-
-
-trans_pixels = np.transpose(pixels,(1,0,2)) #flip the image around so that the coordinate axes are the right way around in the final image (and so that it is right-side up). They should be right-handed.
-output = Image.fromarray(trans_pixels,'RGB')
-output = output.rotate(180, Image.NEAREST, expand = 1) #rotate the image.
-
-output.save("output.png")
-end = time.time()
-
-print("Took "+str(end-start)+" seconds")
+if __name__ == "__main__": #only render when run as a script, so that the scene can be imported without rendering it.
+    if(batched and jit_kernels.enabled):
+        jit_kernels.warm_up() #compile the kernels (or load them from the disk cache) before rendering.
+    if(len(sys.argv) > 1): #a scene file can be given on the command line (e.g. "python raytracing.py scenes/default.json") to render that instead of the scene above.
+        use_scene(*scene_file.load_scene(sys.argv[1]))
+    if(batched and stream_output):
+        render.render_streaming(scene,camera,"output.png",rows_per_batch,workers)
+    elif(batched and adaptive_samples is not None):
+        pixels = antialiasing.render_adaptive(scene,camera,adaptive_samples,edge_threshold,sample_budget)
+    elif(batched and tile_cache_dir is not None):
+        pixels = progressive.render_incremental(scene,camera,tile_cache_dir,tile_size)
+    elif(batched and progressive_step is not None):
+        pixels = progressive.render_progressive(scene,camera,"output.png",progressive_step)
+    elif(batched and workers != 1):
+        pixels = render.render_parallel(scene,camera,workers,tile_size)
+    elif(batched):
+        pixels = render.render(scene,camera,rows_per_batch)
+    else:
+        for i in range(0,len(screen_y_points)): #cast rays at all the points on the screen.
+            for j in range(0,len(screen_z_points)):
+                cast_ray(screen_x,screen_y_points[i],screen_z_points[j],i,j)
+
+
+
+
+    if(not(batched and stream_output)): #the streaming renderer has already saved the image.
+        render.save_image(pixels,"output.png")
+    end = time.time()
+
+    print("Took "+str(end-start)+" seconds")
+    if(batched and profile_path is not None):
+        profiling.save_report(profile_path,{"total_seconds":end-start,"resolution":[camera.res_y,camera.res_z]})
@@ -0,0 +1,334 @@
+# Vectorised versions of the cast_ray, add_color and add_reflection functions in raytracing.py.
+# Instead of following one ray at a time, these work on whole batches of rays stored as (N,3) arrays, so the intersection tests,
+# shading and texture lookups are all done as NumPy operations. The rules for what counts as a hit are the same as in raytracing.py,
+# so the output matches the per-pixel loop.
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from classes import SphereSlice
+from image_output import PNGWriter,output_rows
+import jit_kernels
+import profiling
+
+max_t = 10000 #cast_ray starts its search for the closest object at t = 10000, so anything further away than this is never rendered.
+
+def normalise_rows(v): #normalise each row of an (N,3) array.
+    return v/np.linalg.norm(v,axis=1)[:,None]
+
+def dot_rows(u,v): #the dot product of each row of u with the matching row of v.
+    return np.sum(u*v,axis=1)
+
+def per_object(objects,indices,points,method,extra = None): #call a batch method (e.g. "get_normal_batch") of each object on the points that lie on it, and gather the results into one (N,3) array. If extra is given, the matching part of it is passed to the method too.
+    result = np.zeros((len(points),3))
+    for k,on_object in group_by_object(indices):
+        if(extra is None):
+            result[on_object] = getattr(objects[k],method)(points[on_object])
+        else:
+            result[on_object] = getattr(objects[k],method)(points[on_object],extra[on_object])
+    return result
+
+def group_by_object(indices): #split the positions 0..N-1 into groups that hit the same object. Returns a list of (object index, positions) pairs. Sorting keeps this quick even with thousands of objects.
+    if(len(indices) == 0):
+        return []
+    order = np.argsort(indices,kind="stable")
+    starts = np.flatnonzero(np.diff(indices[order]))+1
+    return [(int(indices[group[0]]),group) for group in np.split(order,starts)]
+
+def nearest_hits(scene,sources,directions): #for each ray, find the t-value of the closest intersection and the index of the object it hits, using the same rules as the loop in cast_ray.
+    with profiling.stage("intersection"):
+        return find_nearest_hits(scene,sources,directions)
+
+def find_nearest_hits(scene,sources,directions):
+    #Also returns whether each ray hit anything at its t_0; add_reflection only counts a reflected ray as a hit in that case.
+    if(scene.bvh is not None):
+        return scene.bvh.closest_hit(sources,directions,max_t)
+    return scene.store.closest_hit(sources,directions,max_t)
+
+class HitBatch: #array version of the Hit class: the points where a batch of rays hit objects, along with everything about them that doesn't depend on the light source.
+    def __init__(self,scene,sources,directions,t_values,indices,cone_widths = None,cone_spreads = None): #worked out once for each batch of hits, then shared by every light source.
+        #cone_widths and cone_spreads are only given when textures are filtered. Each ray stands for a thin cone of rays (one pixel wide), which is
+        #cone_widths wide at the source of the ray and gets wider by cone_spreads for every unit travelled.
+        objects = scene.objects
+        store = scene.store
+        self.sources = sources
+        self.directions = directions
+        self.t_values = t_values
+        self.indices = indices
+        self.points = sources+directions*t_values[:,None]
+        self.normals = store.get_normals(indices,self.points)
+        self.unit_normals = normalise_rows(self.normals)
+        self.unit_views = normalise_rows(-directions) #unit vectors pointing back along the rays, for specular highlights.
+        self.cone_widths = None #how wide each ray's cone is where it hits.
+        self.cone_spreads = cone_spreads
+        footprints = None
+        if(cone_widths is not None):
+            self.cone_widths = cone_widths+cone_spreads*t_values*np.linalg.norm(directions,axis=1)
+            slant = np.abs(dot_rows(self.unit_views,self.unit_normals)) #a cone hitting a surface at a glancing angle covers a longer patch of it.
+            footprints = self.cone_widths/np.sqrt(np.maximum(slant,0.0001)) #the width of a square with the same area as that patch, so that glancing surfaces aren't blurred too much along their width.
+        self.colors = store.colors[indices]
+        textured = np.flatnonzero(store.textured[indices]) #only textured objects need their colours looking up point by point.
+        if(len(textured) > 0):
+            with profiling.stage("texturing"):
+                self.colors[textured] = per_object(objects,indices[textured],self.points[textured],"get_color_batch",None if footprints is None else footprints[textured])
+        self.diffusivity = store.diffusivity[indices]
+        self.specularity = store.specularity[indices]
+        self.shininess = store.shininess[indices]
+        self.reflectivity = store.reflectivity[indices]
+
+    def __len__(self):
+        return len(self.points)
+
+    def subset(self,selected): #the hits picked out by an index array or mask, without working anything out again.
+        part = HitBatch.__new__(HitBatch)
+        for name,value in vars(self).items():
+            setattr(part,name,None if value is None else value[selected])
+        return part
+
+def add_color_batch(scene,hits,light_index): #array version of add_color. Returns the (N,3) colors that light source number light_index adds to the N hits.
+    objects = scene.objects
+    light_source = scene.light_sources[light_index]
+    light_strength = scene.light_strengths[light_index]
+    shadow_vects = light_source-hits.points
+    lit = np.ones(len(hits),dtype=bool)
+
+    for k,on_slice in group_by_object(hits.indices): #a light source can't light up the inside of a SphereSlice when we are looking at the outside (or vice versa).
+        object = objects[k]
+        if(isinstance(object,SphereSlice)):
+            behind_points = hits.sources[on_slice]+hits.directions[on_slice]*(hits.t_values[on_slice]-(0.01*object.radius))[:,None]
+            looking_from_outside = np.linalg.norm(behind_points-object.sphere_centre,axis=1)>object.radius
+            towards_light = hits.points[on_slice]+shadow_vects[on_slice]*(0.01*object.radius)
+            lit_from_outside = np.linalg.norm(towards_light-object.sphere_centre,axis=1)>object.radius
+            lit[on_slice] = ~(lit_from_outside ^ looking_from_outside)
+
+    to_check = np.flatnonzero(lit) #only the points that could be lit need shadow rays.
+    profiling.count_rays("shadow",len(to_check))
+    lit[to_check] = ~scene.occluded(hits.points[to_check],shadow_vects[to_check],light_index) #a shadow ray that hits an object with 0.0001 < t < 1 is blocked before it reaches the light.
+
+    color = np.zeros((len(hits),3),dtype=int)
+    if(not lit.any()):
+        return color
+    if(jit_kernels.enabled):
+        color[lit] = jit_kernels.phong(hits.colors[lit],hits.unit_normals[lit],shadow_vects[lit],hits.unit_views[lit],hits.diffusivity[lit],hits.specularity[lit],hits.shininess[lit],light_strength)
+        return color
+
+    unit_shadow_vects = normalise_rows(shadow_vects[lit])
+    normals = hits.unit_normals[lit]
+    reflection_vectors = (2*dot_rows(unit_shadow_vects,normals)[:,None]*normals) - unit_shadow_vects
+
+    diffuse_brightness = light_strength*np.abs(dot_rows(normals,unit_shadow_vects))*hits.diffusivity[lit]
+    specular_dot = dot_rows(reflection_vectors,hits.unit_views[lit])**hits.shininess[lit]
+    specular_brightness = light_strength*hits.specularity[lit]*np.where(specular_dot>0,specular_dot,0) #np.where rather than np.maximum so that NaNs become 0, like they do with max().
+
+    color[lit] = np.minimum(255,hits.colors[lit]*(diffuse_brightness+specular_brightness)[:,None]).astype(int)
+    return color
+
+def add_reflection_batch(scene,hits,seen_objects = None): #array version of add_reflection. Returns the (N,3) colors that reflections add to the N hits. If seen_objects (a set) is given, the indices of the objects the reflected rays hit are added to it.
+    #Rather than recursing, the reflections are traced as a "wavefront": all the rays still bouncing after k reflections are traced together,
+    #and the ones that miss, or hit something that doesn't reflect, are dropped before the next bounce. alive[n] is the hit that ray n in the
+    #wavefront started from, so that its colour can be added to the right pixel.
+    reflectivities = scene.store.reflectivity.tolist()
+    color_total = np.zeros((len(hits),3),dtype=int)
+    alive = np.arange(len(hits))
+    max_reflectivity = max(reflectivities,default=0)
+    for count in range(0,scene.reflection_limit):
+        if(len(hits) == 0):
+            break
+        if(max_reflectivity < 1 and 255*(max_reflectivity**(1+count)) < 1): #every colour added from here on would be rounded down to 0, so stop early.
+            break
+
+        reflected_vects = hits.directions - 2*dot_rows(hits.directions,hits.normals)[:,None]*hits.normals
+        reflected_sources = hits.points+(0.001*reflected_vects) #start the reflected rays a bit out from the object, as in add_reflection.
+        profiling.count_rays("reflection",len(hits))
+
+        min_reflected_t,next_indices,front_hit = nearest_hits(scene,reflected_sources,reflected_vects)
+        hit = np.flatnonzero(front_hit & (min_reflected_t<max_t))
+        if(len(hit) == 0):
+            break
+
+        cone_widths = None
+        cone_spreads = None
+        if(hits.cone_widths is not None): #reflected cones carry on from where the incoming cones hit (treating the mirror as flat).
+            cone_widths = hits.cone_widths[hit]
+            cone_spreads = hits.cone_spreads[hit]
+        next_hits = HitBatch(scene,reflected_sources[hit],reflected_vects[hit],min_reflected_t[hit],next_indices[hit],cone_widths,cone_spreads)
+        if(seen_objects is not None):
+            seen_objects.update(np.unique(next_hits.indices).tolist())
+        alive = alive[hit]
+        attenuation = np.array([reflectivity**(1+count) for reflectivity in reflectivities])[hits.indices[hit]] #the light picked up on this bounce is scaled by the reflectivity of the mirror it bounced off, to the power of (1+count).
+        for a in range(0,len(scene.light_sources)):
+            new_obj_color = add_color_batch(scene,next_hits,a)
+            color_total[alive] += (attenuation[:,None]*new_obj_color).astype(int) #each starting hit has at most one ray in the wavefront, so the entries of alive are all different.
+
+        reflective = np.flatnonzero(next_hits.reflectivity!=0) #the rays that hit another reflective object keep bouncing.
+        hits = next_hits.subset(reflective)
+        alive = alive[reflective]
+    return color_total
+
+def cast_ray_batch(scene,sources,directions,pixel_size = None,seen_objects = None,return_indices = False): #array version of cast_ray. Returns the (N,3) pixel colors for N primary rays. pixel_size (see Camera.get_pixel_size) is needed to filter textures.
+    #If seen_objects (a set) is given, the indices of all the objects seen by the rays (directly or in reflections) are added to it.
+    #If return_indices is True, the index of the object each ray hit (or -1 if it hit nothing) is returned too, as a second array.
+    #Everything here that isn't finding intersections or looking up textures is counted as shading.
+    profiling.count_rays("primary",len(sources))
+    with profiling.stage("shading"):
+        colors,hit_indices = shade_rays(scene,sources,directions,pixel_size,seen_objects)
+    if(return_indices):
+        return colors,hit_indices
+    return colors
+
+def shade_rays(scene,sources,directions,pixel_size,seen_objects):
+    colors = np.full((len(sources),3),127,dtype=int) #pixels that don't hit anything stay grey.
+    hit_indices = np.full(len(sources),-1)
+    hit,hits = find_primary_hits(scene,sources,directions,pixel_size)
+    if(len(hit) == 0):
+        return colors.astype(np.uint8),hit_indices
+    hit_indices[hit] = hits.indices
+    colors[hit] = shade_hits(scene,hits,seen_objects)
+    return colors.astype(np.uint8),hit_indices
+
+def find_primary_hits(scene,sources,directions,pixel_size = None): #the positions (in the batch) of the primary rays that hit something, and the HitBatch of their hits (None if there are none). Nothing here depends on the light sources.
+    min_prim_t,indices,front_hit = nearest_hits(scene,sources,directions)
+    hit = np.flatnonzero(min_prim_t<max_t)
+    if(len(hit) == 0):
+        return hit,None
+
+    cone_widths = None
+    cone_spreads = None
+    if(scene.texture_filter == "mipmap" and pixel_size is not None): #the primary rays start on the screen, one pixel wide, and spread out from the viewpoint.
+        cone_widths = np.full(len(hit),pixel_size)
+        cone_spreads = pixel_size/np.linalg.norm(directions[hit],axis=1)
+    return hit,HitBatch(scene,sources[hit],directions[hit],min_prim_t[hit],indices[hit],cone_widths,cone_spreads)
+
+def shade_hits(scene,hits,seen_objects = None): #the (N,3) colours of N primary hits: the light each light source adds, plus whatever is seen in reflections.
+    if(seen_objects is not None):
+        seen_objects.update(np.unique(hits.indices).tolist())
+    pixel_colors = np.zeros((len(hits),3),dtype=int)
+    reflective = hits.reflectivity!=0
+    reflection_colors = np.zeros((len(hits),3),dtype=int)
+    if(reflective.any()):
+        reflection_colors[reflective] = add_reflection_batch(scene,hits.subset(reflective),seen_objects)
+
+    for k in range(0,len(scene.light_sources)):
+        color_to_add = add_color_batch(scene,hits,k)
+        pixel_colors = np.minimum(255,pixel_colors+color_to_add)
+        pixel_colors = np.minimum(255,pixel_colors+reflection_colors) #cast_ray adds the reflected colour once for each light source.
+    return pixel_colors
+
+def render_pixels(scene,camera,i_indices,j_indices,batch_size = 20000,seen_objects = None): #render the pixels (i_indices[n],j_indices[n]), tracing batch_size of them at a time. Returns their (N,3) colors.
+    colors = np.empty((len(i_indices),3),dtype=np.uint8)
+    for start in range(0,len(i_indices),batch_size):
+        sources,directions = camera.get_rays(i_indices[start:start+batch_size],j_indices[start:start+batch_size])
+        colors[start:start+batch_size] = cast_ray_batch(scene,sources,directions,camera.get_pixel_size(),seen_objects)
+    return colors
+
+def render_tile(scene,camera,i_start,i_stop,j_start,j_stop,seen_objects = None): #render the pixels with i_start <= i < i_stop and j_start <= j < j_stop. Returns an (i_stop-i_start,j_stop-j_start,3) pixel array.
+    i_indices,j_indices = np.meshgrid(np.arange(i_start,i_stop),np.arange(j_start,j_stop),indexing="ij")
+    sources,directions = camera.get_rays(i_indices.ravel(),j_indices.ravel())
+    return cast_ray_batch(scene,sources,directions,camera.get_pixel_size(),seen_objects).reshape(i_stop-i_start,j_stop-j_start,3)
+
+def get_tiles(camera,tile_size): #split the screen into square tiles of (at most) tile_size x tile_size pixels, given as (i_start,i_stop,j_start,j_stop).
+    return [(i_start,min(i_start+tile_size,camera.res_y),j_start,min(j_start+tile_size,camera.res_z)) for i_start in range(0,camera.res_y,tile_size) for j_start in range(0,camera.res_z,tile_size)]
+
+def render(scene,camera,rows_per_batch = 10): #render the whole screen in this process, tracing "rows_per_batch" rows of pixels at a time. Returns the (res_y,res_z,3) pixel array.
+    scene.pack()
+    pixels = np.full((camera.res_y,camera.res_z,3),127,dtype=np.uint8)
+    for i_start in range(0,camera.res_y,rows_per_batch):
+        i_stop = min(i_start+rows_per_batch,camera.res_y)
+        pixels[i_start:i_stop] = render_tile(scene,camera,i_start,i_stop,0,camera.res_z)
+        print("Rendered rows "+str(i_start)+" to "+str(i_stop-1)+" of "+str(camera.res_y)) #print progress every batch so that we know how the render is progressing.
+    return pixels
+
+worker_state = {} #the scene, camera and shared output buffer of a worker process. Filled in once per worker by init_worker, so the scene is only sent to each worker once rather than with every tile.
+
+def worker_threads(workers): #how many threads each of "workers" processes should give the compiled kernels, so that between them they use each CPU once.
+    return max(1,(os.cpu_count() or 1)//workers)
+
+def init_worker(scene,camera,threads,buffer_name = None): #buffer_name is None when the workers send their pixels back instead (see render_streaming).
+    jit_kernels.set_threads(threads)
+    if(buffer_name is not None):
+        buffer = shared_memory.SharedMemory(name=buffer_name)
+        worker_state["buffer"] = buffer #keep a reference so that the shared memory stays open.
+        worker_state["pixels"] = np.ndarray((camera.res_y,camera.res_z,3),dtype=np.uint8,buffer=buffer.buf)
+    worker_state["scene"] = scene
+    worker_state["camera"] = camera
+
+def render_tile_in_worker(tile): #render a tile and write it straight into the shared output buffer, so the pixels don't have to be sent back to the main process. Returns the profiling counts for the tile, to be added to the main process's.
+    i_start,i_stop,j_start,j_stop = tile
+    profiling.reset()
+    worker_state["pixels"][i_start:i_stop,j_start:j_stop] = render_tile(worker_state["scene"],worker_state["camera"],i_start,i_stop,j_start,j_stop)
+    return profiling.report()
+
+def render_parallel(scene,camera,workers = None,tile_size = 64): #render the screen in tiles of tile_size x tile_size pixels, spread over a pool of "workers" processes (by default, one per CPU). Returns the (res_y,res_z,3) pixel array.
+    if(workers is None):
+        workers = os.cpu_count()
+    scene.pack()
+    tiles = get_tiles(camera,tile_size)
+    buffer = shared_memory.SharedMemory(create=True,size=camera.res_y*camera.res_z*3)
+    try:
+        pixels = np.ndarray((camera.res_y,camera.res_z,3),dtype=np.uint8,buffer=buffer.buf)
+        pixels[:] = 127
+        with ProcessPoolExecutor(max_workers=workers,initializer=init_worker,initargs=(scene,camera,worker_threads(workers),buffer.name)) as pool:
+            for done,tile_report in enumerate(pool.map(render_tile_in_worker,tiles)):
+                profiling.merge(tile_report)
+                if(done%100==0):
+                    print("Rendered "+str(done+1)+" of "+str(len(tiles))+" tiles")
+        result = pixels.copy() #copy the image out before the shared memory is freed.
+        del pixels
+    finally:
+        buffer.close()
+        buffer.unlink()
+    return result
+
+def get_strips(res_z,rows_per_strip): #split a screen res_z pixels high into strips of (at most) rows_per_strip rows of the final image, in the order they appear in it (top first), given as (j_start,j_stop).
+    return [(max(0,j_stop-rows_per_strip),j_stop) for j_stop in range(res_z,0,-rows_per_strip)]
+
+def render_strip_in_worker(strip): #render a strip of the screen, returning its pixels (as rows of the final image) and the profiling counts for it.
+    j_start,j_stop = strip
+    camera = worker_state["camera"]
+    profiling.reset()
+    rows = output_rows(render_tile(worker_state["scene"],camera,0,camera.res_y,j_start,j_stop))
+    return rows,profiling.report()
+
+def render_streaming(scene,camera,path,rows_per_strip = 10,workers = 1): #render the screen and save it as a PNG file at "path", writing each strip of rows_per_strip rows to the file as soon as it is done.
+    #Only a few strips are ever held in memory, rather than the whole image, so very large images can be rendered. With more than one
+    #worker process, each worker renders whole strips, and at most two strips per worker are waiting to be written at any time.
+    scene.pack()
+    strips = get_strips(camera.res_z,rows_per_strip)
+    with PNGWriter(path,camera.res_y,camera.res_z) as writer:
+        def write(done,rows):
+            with profiling.stage("image_output"):
+                writer.write_rows(rows)
+            if(done%10 == 0):
+                print("Written "+str(writer.rows_written)+" of "+str(camera.res_z)+" rows")
+
+        if(workers == 1):
+            for done,(j_start,j_stop) in enumerate(strips):
+                write(done,output_rows(render_tile(scene,camera,0,camera.res_y,j_start,j_stop)))
+            return
+        if(workers is None):
+            workers = os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers,initializer=init_worker,initargs=(scene,camera,worker_threads(workers))) as pool:
+            waiting = deque()
+            for done in range(0,len(strips)):
+                while(len(waiting) < 2*workers and done+len(waiting) < len(strips)):
+                    waiting.append(pool.submit(render_strip_in_worker,strips[done+len(waiting)]))
+                rows,strip_report = waiting.popleft().result() #strips are written in order, so wait for the oldest one.
+                profiling.merge(strip_report)
+                write(done,rows)
+
+def save_image(pixels,path,rows_per_strip = 64): #save a (res_y,res_z,3) pixel array as an image file.
+    #PNG files are written a strip of rows_per_strip rows at a time, so that no full-size copies of the image are made.
+    with profiling.stage("image_output"):
+        if(path.lower().endswith(".png")):
+            with PNGWriter(path,pixels.shape[0],pixels.shape[1]) as writer:
+                for j_start,j_stop in get_strips(pixels.shape[1],rows_per_strip):
+                    writer.write_rows(output_rows(pixels[:,j_start:j_stop]))
+            return
+        trans_pixels = np.transpose(pixels,(1,0,2)) #flip the image around so that the coordinate axes are the right way around in the final image (and so that it is right-side up). They should be right-handed.
+        output = Image.fromarray(trans_pixels,'RGB')
+        output = output.rotate(180, Image.NEAREST, expand = 1) #rotate the image.
+        output.save(path)
@@ -0,0 +1,102 @@
+# Loading scenes from scene files, so that a scene can be changed without editing raytracing.py.
+# A scene file is a JSON (.json) or TOML (.toml) file describing the camera, the light sources, the materials and the objects.
+# See scenes/default.json for an example, which is the same scene as the one defined in raytracing.py.
+#
+# Loading a scene means building all the objects, loading the textures and (optionally) building the bounding volume hierarchy.
+# The result is saved next to the scene file (as <scene file>.cache), along with a hash of the scene file and the textures it uses,
+# so that loading the same scene again just reads the cache back in.
+import hashlib
+import json
+import os
+import pickle
+import tomllib
+
+import numpy as np
+
+from classes import Sphere,Plane,SphereSlice,Material,Scene,Camera
+
+cache_version = 5 #change this whenever the classes change in a way that would make old cache files wrong.
+
+def read_scene_file(path): #read a scene file into a dictionary.
+    with open(path,"rb") as scene_file:
+        if(path.endswith(".toml")):
+            return tomllib.load(scene_file)
+        return json.load(scene_file)
+
+def texture_paths(description,scene_dir): #the paths of all the textures used by the objects in a scene description. Texture paths are relative to the scene file.
+    return sorted({os.path.join(scene_dir,object["texture"]) for object in description.get("objects",[]) if "texture" in object})
+
+def scene_hash(path,description): #a hash of the scene file and of every texture it uses. If any of them change, the cached scene is out of date.
+    hasher = hashlib.sha256()
+    hasher.update(str(cache_version).encode())
+    with open(path,"rb") as scene_file:
+        hasher.update(scene_file.read())
+    for texture_path in texture_paths(description,os.path.dirname(path)):
+        hasher.update(texture_path.encode())
+        try:
+            with open(texture_path,"rb") as texture_file:
+                hasher.update(texture_file.read())
+        except FileNotFoundError:
+            hasher.update(b"missing")
+    return hasher.hexdigest()
+
+def make_material(description):
+    return Material(description.get("color",[255,255,255]),diffusivity=description.get("diffusivity",1),specularity=description.get("specularity",0),shininess=description.get("shininess",1),reflectivity=description.get("reflectivity",0.0))
+
+def build_scene(description,scene_dir): #build the Scene and Camera described by a scene file.
+    materials = {name:make_material(material) for name,material in description.get("materials",{}).items()}
+    def get_material(object): #objects either name one of the materials, or describe their own material.
+        if(isinstance(object["material"],str)):
+            return materials[object["material"]]
+        return make_material(object["material"])
+
+    objects = []
+    for object in description["objects"]:
+        if(object["type"] == "sphere"):
+            objects.append(Sphere(np.array(object["centre"]),object["radius"],get_material(object)))
+        elif(object["type"] == "plane"):
+            texture_path = None
+            if("texture" in object):
+                texture_path = os.path.join(scene_dir,object["texture"]) #textures are loaded through the texture cache, so each one is only decoded once however many planes use it.
+            objects.append(Plane(np.array(object["point"]),np.array(object["normal"]),get_material(object),texture_path=texture_path,second_point=np.array(object.get("second_point",[0,0,0])),tex_size=object.get("tex_size",100)))
+        elif(object["type"] == "sphere_slice"):
+            objects.append(SphereSlice(np.array(object["edge_centre"]),object["radius"],np.array(object["pole_dir"]),object["max_edge_dist"],get_material(object)))
+        else:
+            raise ValueError("Unknown object type in scene file: "+str(object["type"]))
+
+    lights = description.get("lights",[])
+    scene = Scene(objects,[np.array(light["position"]) for light in lights],[light.get("strength",1) for light in lights],description.get("reflection_limit",4),description.get("texture_filter","nearest"))
+    if(description.get("bvh",False)):
+        scene.build_bvh()
+
+    view = description["camera"]
+    camera = Camera(np.array(view["viewpoint"]),view["screen_x"],view["screen_y"][0],view["screen_y"][1],view["screen_z"][0],view["screen_z"][1],view["resolution"][0],view["resolution"][1])
+    return scene,camera
+
+def load_scene(path,use_cache = True): #load a scene file, returning the Scene and the Camera. If use_cache is True, reuse the cached scene if the scene file and its textures haven't changed.
+    description = read_scene_file(path)
+    cache_path = path+".cache"
+    key = scene_hash(path,description)
+    if(use_cache):
+        try:
+            with open(cache_path,"rb") as cache_file:
+                if(pickle.load(cache_file) == key): #the key is stored first, so an out of date cache can be spotted without reading the rest.
+                    return pickle.load(cache_file)
+        except (OSError,pickle.UnpicklingError,EOFError,AttributeError,ImportError):
+            pass #no cache yet, or one that can't be read. Either way, build the scene from scratch.
+
+    scene,camera = build_scene(description,os.path.dirname(path))
+    if(use_cache):
+        temp_path = cache_path+"."+str(os.getpid())+".tmp.cache" #write to a temporary file first, so other processes never see a half-written cache file.
+        try:
+            with open(temp_path,"wb") as cache_file:
+                pickle.dump(key,cache_file)
+                pickle.dump((scene,camera),cache_file,protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path,cache_path)
+        except OSError:
+            print("Couldn't write the scene cache "+cache_path+", continuing without it")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+    return scene,camera
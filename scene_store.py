@@ -0,0 +1,167 @@
+# A packed copy of the objects in a scene, for the vectorised renderer.
+# The parameters of every shape of the same type are stored together in contiguous arrays (all the sphere centres in one (S,3) array,
+# all the radii in one (S,) array, and so on), along with the material properties of every object. Batches of rays are then
+# intersected with a whole block of shapes at once, rather than calling each object in turn, and hits can look up their material
+# properties by object index without building new arrays.
+# The arithmetic is the same as in the intersects_batch methods of the shapes, so the results match rendering object by object.
+# Shapes describe themselves through their get_packed method; see classes.py.
+# If Numba is installed, the compiled kernels in jit_kernels.py are used instead of the NumPy ones here.
+import numpy as np
+
+import jit_kernels
+import profiling
+
+block_elements = 2**16 #the most (ray, shape) pairs tested at once, which keeps the temporary arrays a few MB in size.
+
+# The kernels below work on (B,N) arrays, with a row for each of B shapes and a column for each of N rays, so that the inner loops
+# run along the (long) rows of rays. The ray sources and directions are given as (3,N) arrays (x, y and z rows) for the same reason.
+
+def sphere_kernel(sources,directions,centres,radii): #intersect N rays with B spheres. Returns (B,N) arrays of t_0, t_1 and whether the ray meets the sphere at all.
+    x0,y0,z0 = sources
+    x1,y1,z1 = directions
+    cx,cy,cz = centres[:,0,None],centres[:,1,None],centres[:,2,None]
+    a = x1**2 + y1**2 + z1**2
+    b = 2*((x1*(x0-cx)) +(y1*(y0-cy))+(z1*(z0-cz)))
+    c = (x0-cx)**2 +(y0-cy)**2+(z0-cz)**2 - (radii**2)[:,None]
+
+    discriminant = b**2 - (4*a*c)
+    hit = discriminant >= 0
+    root = np.sqrt(np.where(hit,discriminant,0))
+    t_0 = (-b - root)/(2*a)
+    t_1 = (-b + root)/(2*a)
+    return t_0,t_1,hit
+
+def sphere_hits(sources,directions,centres,radii): #like Sphere.intersects_batch, for B spheres at once.
+    t_0,t_1,hit = sphere_kernel(sources,directions,centres,radii)
+    hit_0 = hit & ~((t_0<0) & (t_1>0)) #if the ray starts inside the sphere, only t_1 counts.
+    return np.where(hit_0,t_0,0),np.where(hit,t_1,0),hit_0,hit
+
+def plane_hits(sources,directions,normals,offsets): #like Plane.intersects_batch, for B planes at once.
+    denominators = normals@directions
+    with np.errstate(divide="ignore",invalid="ignore"):
+        t_int = (offsets[:,None] - normals@sources)/denominators
+    hit = (denominators!=0) & (t_int>=0)
+    t_int = np.where(hit,t_int,0)
+    return t_int,t_int,hit,hit
+
+def slice_hits(sources,directions,centres,radii,cutoff_normals,cutoff_offsets): #like SphereSlice.intersects_batch, for B slices at once.
+    t_0,t_1,hit = sphere_kernel(sources,directions,centres,radii)
+    def inside_cutoff(t_values): #whether the points at t_values are on the slice side of each slice's cutoff plane.
+        distances = 0
+        for axis in range(0,3):
+            distances = distances+(sources[axis]+directions[axis]*t_values)*cutoff_normals[:,axis,None]
+        return distances<=cutoff_offsets[:,None]
+    cutoff_0 = hit & inside_cutoff(t_0)
+    cutoff_1 = hit & inside_cutoff(t_1)
+    return np.where(cutoff_0,t_0,0),np.where(cutoff_1,t_1,0),cutoff_0,cutoff_1
+
+class ShapeGroup: #the packed parameters of all the shapes of one type, and the function that intersects rays with them.
+    __slots__ = ("name","indices","parameters","kernel")
+
+    def __init__(self,name,indices,parameters,kernel):
+        self.name = name #the type of shape, for profiling.
+        self.indices = np.array(indices,dtype=int) #the index of each shape in the scene's object list, in increasing order.
+        self.parameters = [np.ascontiguousarray(np.array(parameter,dtype=float)) for parameter in parameters] #one array per parameter, with a row for each shape.
+        self.kernel = kernel
+
+    def blocks(self,ray_count): #split the shapes into blocks small enough to test against ray_count rays at once. Yields (object indices, parameters) for each block.
+        block_size = max(1,block_elements//max(1,ray_count))
+        for start in range(0,len(self.indices),block_size):
+            yield self.indices[start:start+block_size],[parameter[start:start+block_size] for parameter in self.parameters]
+
+    def intersect(self,sources,directions,parameters): #sources and directions are (3,N) arrays.
+        profiling.count_tests(self.name,sources.shape[1]*len(parameters[0]))
+        return self.kernel(sources,directions,*parameters)
+
+kernels = {"Sphere":sphere_hits,"Plane":plane_hits,"SphereSlice":slice_hits}
+
+class SceneStore:
+    def __init__(self,objects):
+        count = len(objects)
+        self.colors = np.zeros((count,3)) #the material properties of every object, by index.
+        self.diffusivity = np.zeros(count)
+        self.specularity = np.zeros(count)
+        self.shininess = np.zeros(count)
+        self.reflectivity = np.zeros(count)
+        self.textured = np.zeros(count,dtype=bool) #objects whose colour comes from a texture, rather than their material.
+        self.centres = np.zeros((count,3)) #for round objects, the centre of the sphere (normals point away from it)...
+        self.radii = np.ones(count)
+        self.flat_normals = np.zeros((count,3)) #...and for flat ones, their normal.
+        self.round = np.zeros(count,dtype=bool)
+
+        grouped = {}
+        for k,object in enumerate(objects):
+            material = object.material
+            self.colors[k] = np.asarray(material.color,dtype=float)[:3]
+            self.diffusivity[k] = material.diffusivity
+            self.specularity[k] = material.specularity
+            self.shininess[k] = material.shininess
+            self.reflectivity[k] = material.reflectivity
+            name,parameters,textured = object.get_packed()
+            self.textured[k] = textured
+            if(name == "Plane"):
+                self.flat_normals[k] = parameters[0]
+            else:
+                self.centres[k] = parameters[0]
+                self.radii[k] = parameters[1]
+                self.round[k] = True
+            indices,values = grouped.setdefault(name,([],[]))
+            indices.append(k)
+            values.append(parameters)
+        self.groups = [ShapeGroup(name,indices,zip(*values),kernels[name]) for name,(indices,values) in grouped.items()]
+        self.jit_arrays = None
+
+    def get_jit_arrays(self): #the packed arrays in the order the kernels in jit_kernels.py take them, with empty arrays for any type of shape the scene doesn't have.
+        if(self.jit_arrays is None):
+            shapes = {group.name:group for group in self.groups}
+            arrays = []
+            for name,widths in (("Sphere",(3,None)),("Plane",(3,None)),("SphereSlice",(3,None,3,None))):
+                group = shapes.get(name)
+                arrays.append(np.zeros(0,dtype=np.int64) if group is None else group.indices.astype(np.int64))
+                for k,width in enumerate(widths):
+                    if(group is None):
+                        arrays.append(np.zeros((0,width) if width else 0))
+                    else:
+                        arrays.append(group.parameters[k])
+            self.jit_arrays = tuple(arrays)
+        return self.jit_arrays
+
+    def closest_hit(self,sources,directions,max_t = 10000): #find the closest intersection of each ray, following the same rules as nearest_hits in render.py. Returns the t-values, the object indices and whether each ray hit anything at its t_0.
+        if(jit_kernels.enabled):
+            return jit_kernels.closest_hit(self.get_jit_arrays(),sources,directions,max_t)
+        min_t = np.full(len(sources),max_t,dtype=float)
+        min_index = np.zeros(len(sources),dtype=int)
+        front_hit = np.zeros(len(sources),dtype=bool)
+        sources,directions = np.ascontiguousarray(sources.T),np.ascontiguousarray(directions.T)
+        for group in self.groups:
+            for indices,parameters in group.blocks(len(min_t)):
+                t_0,t_1,hit_0,hit_1 = group.intersect(sources,directions,parameters)
+                trace_t = np.where(t_0>0,t_0,np.where(t_1>0,t_1,max_t))
+                front_hit |= (t_0>0).any(axis=0)
+                for k,row in zip(indices,trace_t): #going through the shapes one row at a time is quicker than np.argmin along the columns.
+                    closer = (row<min_t) | ((row==min_t) & (k<min_index) & (row<max_t)) #ties go to the object that comes first in the list.
+                    min_t[closer] = row[closer]
+                    min_index[closer] = k
+        return min_t,min_index,front_hit
+
+    def occluders(self,sources,directions,t_min = 0.0001,t_max = 1): #find an object that each ray hits with t_min < t < t_max, giving its index (or -1 if there isn't one). Rays stop being tested once something blocks them.
+        if(jit_kernels.enabled):
+            return jit_kernels.occluders(self.get_jit_arrays(),sources,directions,t_min,t_max)
+        occluders = np.full(len(sources),-1)
+        sources,directions = np.ascontiguousarray(sources.T),np.ascontiguousarray(directions.T)
+        for group in self.groups:
+            for indices,parameters in group.blocks(len(occluders)):
+                rays = np.flatnonzero(occluders<0)
+                if(len(rays) == 0):
+                    return occluders
+                t_0,t_1,hit_0,hit_1 = group.intersect(sources[:,rays],directions[:,rays],parameters)
+                blocked = (hit_0 & (t_min<t_0) & (t_0<t_max)) | (hit_1 & (t_min<t_1) & (t_1<t_max))
+                any_blocked = blocked.any(axis=0)
+                occluders[rays[any_blocked]] = indices[np.argmax(blocked[:,any_blocked],axis=0)]
+        return occluders
+
+    def get_normals(self,indices,points): #the normals at points on the objects with the given indices, like each object's get_normal_batch.
+        normals = self.flat_normals[indices]
+        round = self.round[indices]
+        normals[round] = (points[round]-self.centres[indices[round]])/self.radii[indices[round]][:,None]
+        return normals
@@ -0,0 +1,115 @@
+# A cache for texture images, so that each texture is only decoded once.
+# Within a process, every plane using the same texture file gets the same (read-only) array. The decoded pixels are also saved
+# as .npy files in texture_cache_dir, and loaded back as memory-mapped arrays, so other processes (e.g. the workers used by
+# render.render_parallel) skip the decoding too and share the same memory for the pixels.
+import hashlib
+import os
+
+import numpy as np
+from PIL import Image
+
+texture_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),".texture_cache") #where the decoded textures are kept.
+
+loaded_textures = {} #the textures already loaded in this process, keyed by (absolute path, modification time).
+
+def cache_file_prefix(path): #decoded copies of a texture file all start with this, followed by the modification time of the file they were made from.
+    return hashlib.sha1(path.encode()).hexdigest()+"_"
+
+def decode_texture(path): #decode an image file into an array of RGB pixels.
+    with Image.open(path,mode="r") as image:
+        return np.asarray(image.convert("RGB"))
+
+def save_decoded(path,prefix,cache_path,pixels): #save the decoded pixels, and clear out any copies made from older versions of the file.
+    os.makedirs(texture_cache_dir,exist_ok=True)
+    temp_path = cache_path+"."+str(os.getpid())+".tmp.npy" #write to a temporary file first, so other processes never see a half-written cache file.
+    np.save(temp_path,pixels)
+    os.replace(temp_path,cache_path)
+    for name in os.listdir(texture_cache_dir):
+        if(name.startswith(prefix) and os.path.join(texture_cache_dir,name) != cache_path and not name.endswith(".tmp.npy")):
+            try:
+                os.remove(os.path.join(texture_cache_dir,name))
+            except OSError:
+                pass
+
+def load_texture(path): #get the pixels of a texture file as a read-only (res_x,res_y,3) array. Raises FileNotFoundError if the file doesn't exist.
+    path = os.path.abspath(path)
+    modified = os.stat(path).st_mtime_ns
+    key = (path,modified)
+    if(key in loaded_textures):
+        return loaded_textures[key]
+
+    prefix = cache_file_prefix(path)
+    cache_path = os.path.join(texture_cache_dir,prefix+str(modified)+".npy")
+    try:
+        pixels = np.load(cache_path,mmap_mode="r")
+    except (OSError,ValueError): #not decoded yet (or the cache file is damaged), so decode it now.
+        pixels = decode_texture(path)
+        try:
+            save_decoded(path,prefix,cache_path,pixels)
+            pixels = np.load(cache_path,mmap_mode="r")
+        except OSError: #can't write to the cache, so just keep the decoded pixels in memory.
+            pixels.flags.writeable = False
+    loaded_textures[key] = pixels
+    return pixels
+
+loaded_mipmaps = {} #the mip pyramids already built in this process, keyed the same way as loaded_textures.
+
+def build_mipmaps(pixels): #build a mip pyramid: level 0 is the texture itself, and each level after that is half the size of the one before, with each pixel the average of a 2x2 block. Distant surfaces sample from the smaller levels so that they don't alias.
+    levels = [np.asarray(pixels,dtype=np.float32)]
+    while(min(levels[-1].shape[0],levels[-1].shape[1]) > 1):
+        level = levels[-1]
+        if(level.shape[0]%2 == 1): #textures repeat, so odd sizes are evened up by wrapping the first row or column around.
+            level = np.concatenate((level,level[:1]),axis=0)
+        if(level.shape[1]%2 == 1):
+            level = np.concatenate((level,level[:,:1]),axis=1)
+        levels.append((level[0::2,0::2]+level[1::2,0::2]+level[0::2,1::2]+level[1::2,1::2])/4)
+    return levels
+
+def load_mipmaps(path): #get the mip pyramid of a texture file, building it the first time it is needed.
+    path = os.path.abspath(path)
+    key = (path,os.stat(path).st_mtime_ns)
+    if(key not in loaded_mipmaps):
+        loaded_mipmaps[key] = build_mipmaps(load_texture(path))
+    return loaded_mipmaps[key]
+
+def sample_nearest(image,x_coords,y_coords): #look up the texture pixels at the given texture coordinates, truncating the coordinates like get_color_at_point does. The texture repeats in both directions.
+    x_coords = x_coords.astype(int)
+    y_coords = y_coords.astype(int)
+    return image[x_coords%image.shape[0],y_coords%image.shape[1]]
+
+def sample_bilinear(image,x_coords,y_coords): #blend the four texture pixels nearest to each of the given texture coordinates. Pixel (x,y) covers x <= x_coord < x+1, so its centre is at x+0.5.
+    x_coords = x_coords-0.5
+    y_coords = y_coords-0.5
+    x_0 = np.floor(x_coords)
+    y_0 = np.floor(y_coords)
+    x_frac = (x_coords-x_0)[:,None]
+    y_frac = (y_coords-y_0)[:,None]
+    x_0 = x_0.astype(int)%image.shape[0]
+    y_0 = y_0.astype(int)%image.shape[1]
+    x_1 = (x_0+1)%image.shape[0]
+    y_1 = (y_0+1)%image.shape[1]
+    top = image[x_0,y_0]*(1-y_frac)+image[x_0,y_1]*y_frac
+    bottom = image[x_1,y_0]*(1-y_frac)+image[x_1,y_1]*y_frac
+    return top*(1-x_frac)+bottom*x_frac
+
+def sample_mipmapped(levels,x_coords,y_coords,footprints): #sample a mip pyramid, given the coordinates in level 0 and how many level 0 pixels wide each sample's footprint is.
+    #Where the footprint is at most one pixel, the texture is being magnified, so just use the nearest pixel (as get_color_at_point does).
+    #Otherwise pick the two levels whose pixels are closest to the footprint in size, sample both bilinearly and blend between them.
+    colors = np.empty((len(x_coords),levels[0].shape[2]))
+    magnified = footprints<=1
+    colors[magnified] = sample_nearest(levels[0],x_coords[magnified],y_coords[magnified])
+
+    minified = np.flatnonzero(~magnified)
+    level_positions = np.clip(np.log2(footprints[minified]),0,len(levels)-1)
+    lower_levels = np.minimum(level_positions.astype(int),len(levels)-2) if len(levels) > 1 else np.zeros(len(minified),dtype=int)
+    for level in np.unique(lower_levels):
+        in_level = lower_levels==level
+        samples = minified[in_level]
+        scale = 2.0**level
+        lower = sample_bilinear(levels[level],x_coords[samples]/scale,y_coords[samples]/scale)
+        if(level+1 < len(levels)):
+            upper = sample_bilinear(levels[level+1],x_coords[samples]/(2*scale),y_coords[samples]/(2*scale))
+            blend = np.clip(level_positions[in_level]-level,0,1)[:,None]
+            lower = lower*(1-blend)+upper*blend
+        colors[samples] = lower
+    return colors